@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# plays many seeded games headless with the built-in bot (pyrogue.BotInput), spread over all the cores,
+# and reports how long it survived, how many monsters it killed and how many items it used. with --set
+# and --sweep the balance constants (MAX_ROOM_MONSTERS, HEAL_AMOUNT, ORC_POWER, ...) can be changed to
+# see what a change does to the game before playing it by hand.
+
+import argparse, itertools, json, multiprocessing, os, platform, statistics, sys, time
+import numpy as np
+import tcod as tcod
+import pyrogue
+
+def parse_value(text):
+	# numbers stay numbers, anything else (like a generator name) is a string
+	for kind in (int, float):
+		try:
+			return kind(text)
+		except ValueError:
+			pass
+	return text
+
+def parse_setting(text):
+	(name, value) = text.split('=', 1)
+	if not hasattr(pyrogue, name):
+		raise argparse.ArgumentTypeError('pyrogue has no setting %r' % name)
+	return name, value
+
+def play(job):
+	# one game in a worker process: set the constants, let the bot play and return the outcome
+	(index, seed, params, max_turns) = job
+	for (name, value) in params.items():
+		setattr(pyrogue, name, value)
+	pyrogue.headless = True
+	pyrogue.new_game(seed)
+	pyrogue.play_game(pyrogue.BotInput(max_turns))
+	return index, {
+		'seed': seed,
+		'survived': pyrogue.game_state != 'dead',
+		'turns': pyrogue.game_stats['turns'],
+		'kills': pyrogue.game_stats['kills'],
+		'items used': pyrogue.game_stats['items used'],
+		'level': pyrogue.dungeon_level,
+		'hp': max(0, pyrogue.player.fighter.hp) if pyrogue.player.fighter else 0,
+	}
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def aggregate(params, games):
+	turns = [game['turns'] for game in games]
+	return {
+		'params': params,
+		'games': len(games),
+		'survival': sum(game['survived'] for game in games) / len(games),
+		'turns': {
+			'mean': statistics.mean(turns),
+			'median': statistics.median(turns),
+			'p10': percentile(turns, 0.1),
+			'p90': percentile(turns, 0.9),
+		},
+		'kills': statistics.mean(game['kills'] for game in games),
+		'items used': statistics.mean(game['items used'] for game in games),
+		'level': statistics.mean(game['level'] for game in games),
+	}
+
+def param_sets(settings, sweeps):
+	# every combination of the swept values, on top of the fixed settings
+	fixed = {name: parse_value(value) for (name, value) in settings}
+	names = [name for (name, values) in sweeps]
+	choices = [[parse_value(value) for value in values.split(',')] for (name, values) in sweeps]
+	return [dict(fixed, **dict(zip(names, combination))) for combination in itertools.product(*choices)]
+
+def main():
+	parser = argparse.ArgumentParser(description='Play many games of pyrogue with a bot and report the balance.')
+	parser.add_argument('--games', type=int, default=100, help='games to play for each set of settings')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the first game, the others count up from it')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes (default: one per core)')
+	parser.add_argument('--max-turns', type=int, default=1000, help='keys the bot presses before giving up')
+	parser.add_argument('--set', type=parse_setting, action='append', default=[], metavar='NAME=VALUE',
+		help='change a constant for every game, like HEAL_AMOUNT=6')
+	parser.add_argument('--sweep', type=parse_setting, action='append', default=[], metavar='NAME=V1,V2,...',
+		help='play the games once for each value; several sweeps try every combination')
+	parser.add_argument('--games-output', type=argparse.FileType('w'),
+		help='file to write every game\'s outcome to, one JSON object per line')
+	parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+		help='file to write the JSON report to (default: stdout)')
+	args = parser.parse_args()
+
+	sets = param_sets(args.set, args.sweep)
+	jobs = [(index, args.seed + game, params, args.max_turns)
+		for (index, params) in enumerate(sets) for game in range(args.games)]
+	games = [[] for params in sets]
+
+	# the games are independent, so they go to the pool in chunks and come back in whatever order they finish
+	start = time.perf_counter()
+	context = multiprocessing.get_context('spawn')
+	with context.Pool(args.jobs) as pool:
+		chunksize = max(1, len(jobs) // (args.jobs * 8))
+		for (done, (index, game)) in enumerate(pool.imap_unordered(play, jobs, chunksize), 1):
+			games[index].append(game)
+			if args.games_output:
+				args.games_output.write(json.dumps(dict(game, params=sets[index])) + '\n')
+			sys.stderr.write('\r%d/%d games' % (done, len(jobs)))
+	sys.stderr.write('\n')
+	elapsed = time.perf_counter() - start
+
+	json.dump({
+		'version': 1,
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'tcod': tcod.__version__,
+		'jobs': args.jobs,
+		'max_turns': args.max_turns,
+		'elapsed': elapsed,
+		'games_per_second': len(jobs) / elapsed,
+		'results': [aggregate(params, results) for (params, results) in zip(sets, games)],
+	}, args.output, indent=1)
+	args.output.write('\n')
+
+if __name__ == '__main__':
+	main()
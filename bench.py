@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# benchmarks for the hot paths of pyrogue: map generation, FOV, rendering, blocking checks and monster turns,
+# and how long it takes to start: importing the module, and getting from there to the first frame.
+# everything runs headless with fixed seeds, and the results come out as JSON so runs can be compared.
+
+import argparse, io, json, os, platform, statistics, subprocess, sys, tempfile, time
+import numpy as np
+import tcod as tcod
+import pyrogue
+
+def parse_size(text):
+	(width, height) = text.lower().split('x')
+	return int(width), int(height)
+
+def timed(function, repeat):
+	# run the function the given number of times and return how long each run took, in seconds
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return times
+
+def summary(name, params, times, ops=1):
+	return {
+		'name': name,
+		'params': dict(params),
+		'repeat': len(times),
+		'ops': ops,
+		'min': min(times),
+		'median': statistics.median(times),
+		'mean': statistics.mean(times),
+	}
+
+def setup(width, height, max_rooms, room_monsters, seed):
+	# set the map constants and start a headless game with them
+	pyrogue.headless = True
+	pyrogue.MAP_WIDTH = width
+	pyrogue.MAP_HEIGHT = height
+	pyrogue.MAX_ROOMS = max_rooms
+	pyrogue.MAX_ROOM_MONSTERS = room_monsters
+	pyrogue.new_game(seed)
+
+def reset_objects(seed):
+	# everything make_map needs to start over: fresh random numbers and only the player on the map
+	pyrogue.seed_rngs(seed)
+	pyrogue.seed_level_rngs(1)
+	pyrogue.destroy_level_objects()
+	pyrogue.objects = []
+	pyrogue.object_index = pyrogue.SpatialIndex()
+	pyrogue.decorations = pyrogue.Decorations()
+	pyrogue.scheduler.clear()
+	pyrogue.visible = pyrogue.VisibleObjects()
+	pyrogue.dirty.mark_all()
+	pyrogue.add_object(pyrogue.player)
+
+def spawn_orcs(count, rng):
+	# put extra orcs on random free floor tiles, on top of what make_map placed
+	(xs, ys) = np.nonzero(~pyrogue.map.blocked)
+	for i in rng.permutation(len(xs))[:count]:
+		(x, y) = (int(xs[i]), int(ys[i]))
+		if not pyrogue.is_blocked(x, y):
+			fighter_component = pyrogue.Fighter(hp=10, defense=0, power=3, death_function=pyrogue.monster_death)
+			monster = pyrogue.Object(x, y, 'o', 'orc', tcod.desaturated_green,
+				blocks=True, fighter=fighter_component, ai=pyrogue.BasicMonster())
+			pyrogue.add_object(monster)
+
+def time_import():
+	# importing pyrogue in a fresh interpreter, as every launch of the game does. it runs next to the
+	# game's own file, so it finds the same pyrogue wherever the benchmark was started from
+	code = 'import time; start = time.perf_counter(); import pyrogue; print(time.perf_counter() - start)'
+	return float(subprocess.run([sys.executable, '-W', 'ignore', '-c', code],
+		cwd=os.path.dirname(os.path.abspath(pyrogue.__file__)), capture_output=True, check=True, text=True).stdout)
+
+def startup(repeat, seed):
+	# the time to import the game, and to build a new game and draw its first frame. the frame goes to the
+	# terminal backend, which needs no window, with and without the starting level in the level cache
+	params = {'width': pyrogue.MAP_WIDTH, 'height': pyrogue.MAP_HEIGHT, 'generator': pyrogue.MAP_GENERATOR, 'seed': seed}
+	results = [summary('import', params, [time_import() for i in range(repeat)])]
+
+	def first_frame():
+		pyrogue.init_terminal(io.BytesIO())
+		pyrogue.new_game(seed)
+		pyrogue.render_all()
+		pyrogue.present()
+	pyrogue.headless = False
+	results.append(summary('first_frame', params, timed(first_frame, repeat)))
+	with tempfile.TemporaryDirectory() as cache:
+		pyrogue.LEVEL_CACHE_DIR = cache
+		first_frame()
+		results.append(summary('first_frame_cached', params, timed(first_frame, repeat)))
+		pyrogue.LEVEL_CACHE_DIR = None
+	pyrogue.terminal = None
+	pyrogue.root = 0
+	return results
+
+def run(width, height, max_rooms, room_monsters, extra_monsters, lookups, repeat, seed):
+	params = {
+		'width': width, 'height': height, 'max_rooms': max_rooms,
+		'room_monsters': room_monsters, 'extra_monsters': extra_monsters, 'seed': seed,
+		'generator': pyrogue.MAP_GENERATOR,
+	}
+	results = []
+	setup(width, height, max_rooms, room_monsters, seed)
+
+	def make_map():
+		reset_objects(seed)
+		pyrogue.make_map()
+	results.append(summary('make_map', params, timed(make_map, repeat)))
+
+	rng = np.random.default_rng(seed)
+	spawn_orcs(extra_monsters, rng)
+	params['objects'] = len(pyrogue.objects)
+
+	results.append(summary('make_fov_map', params, timed(pyrogue.make_fov_map, repeat)))
+	pyrogue.fov_map = pyrogue.make_fov_map()
+	def compute_fov():
+		pyrogue.fov_cache.clear()
+		pyrogue.compute_fov()
+	results.append(summary('compute_fov', params, timed(compute_fov, repeat)))
+	# the same position again, as when the player steps back onto a tile
+	results.append(summary('compute_fov_cached', params, timed(pyrogue.compute_fov, repeat)))
+
+	# the tile pass draws into the off-screen map console, no window needed. it only looks at the tiles around
+	# the player, except for the first time after the consoles are made, which is timed on its own
+	def color_tiles_full():
+		pyrogue.dirty.mark_all()
+		pyrogue.color_tiles()
+	results.append(summary('color_tiles_full', params, timed(color_tiles_full, repeat)))
+	results.append(summary('color_tiles', params, timed(pyrogue.color_tiles, repeat)))
+
+	def draw_objects():
+		pyrogue.dirty.mark_all()
+		pyrogue.draw_dirty_cells()
+	results.append(summary('draw_objects', params, timed(draw_objects, repeat)))
+
+	xs = rng.integers(0, width, lookups)
+	ys = rng.integers(0, height, lookups)
+	points = list(zip(xs.tolist(), ys.tolist()))
+	def is_blocked():
+		for (x, y) in points:
+			pyrogue.is_blocked(x, y)
+	results.append(summary('is_blocked', params, timed(is_blocked, repeat), ops=lookups))
+
+	# monsters move, so every round starts from a copy of the same game
+	snapshot = pyrogue.dump_game()
+	def monster_turns():
+		pyrogue.load_game_from_bytes(snapshot)
+		pyrogue.compute_fov()
+		start = time.perf_counter()
+		pyrogue.take_monster_turns()
+		return time.perf_counter() - start
+	results.append(summary('take_monster_turns', params, [monster_turns() for i in range(repeat)]))
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the hot paths of pyrogue.')
+	parser.add_argument('--sizes', default='80x45,200x200,500x500',
+		help='comma-separated map sizes to run, as WIDTHxHEIGHT')
+	parser.add_argument('--max-rooms', type=int,
+		help='room placement attempts (default: MAX_ROOMS scaled by the map area)')
+	parser.add_argument('--room-monsters', type=int, default=pyrogue.MAX_ROOM_MONSTERS,
+		help='maximum monsters per room')
+	parser.add_argument('--generator', choices=sorted(pyrogue.MAP_GENERATORS), default=pyrogue.MAP_GENERATOR,
+		help='dungeon generator make_map uses')
+	parser.add_argument('--monsters', type=int, default=0, help='extra orcs to spawn on top of the rooms\' own')
+	parser.add_argument('--lookups', type=int, default=10000, help='is_blocked calls per run')
+	parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark')
+	parser.add_argument('--seed', type=int, default=1, help='seed for the game and the benchmark data')
+	parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+		help='file to write the JSON results to (default: stdout)')
+	args = parser.parse_args()
+
+	pyrogue.MAP_GENERATOR = args.generator
+	base_area = pyrogue.MAP_WIDTH * pyrogue.MAP_HEIGHT
+	base_rooms = pyrogue.MAX_ROOMS
+	results = startup(args.repeat, args.seed)
+	for size in args.sizes.split(','):
+		(width, height) = parse_size(size)
+		max_rooms = args.max_rooms or max(1, base_rooms * width * height // base_area)
+		results += run(width, height, max_rooms, args.room_monsters, args.monsters,
+			args.lookups, args.repeat, args.seed)
+
+	json.dump({
+		'version': 1,
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'tcod': tcod.__version__,
+		'results': results,
+	}, args.output, indent=1)
+	args.output.write('\n')
+
+if __name__ == '__main__':
+	main()
@@ -1,8 +1,11 @@
 #!/usr/bin/python3
 
-import tcod as tcod, math, textwrap
+import tcod as tcod, math, textwrap, argparse, collections, json, zlib, struct
+import concurrent.futures, multiprocessing, contextlib, time, tempfile, os, heapq, bisect, select, sys, hashlib
+import numpy as np
 
 INVENTORY_WIDTH = 50
+MENU_CACHE_SIZE = 8   #menus kept drawn, to show again without drawing them
 HEAL_AMOUNT = 4
 LIGHTNING_DAMAGE = 20
 LIGHTNING_RANGE = 5
@@ -13,9 +16,37 @@ CONFUSE_RANGE = 8
 FOV_ALGO = 0
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
+# how much memory the FOVs kept for when the player comes back to a tile can take up, in bytes
+FOV_CACHE_BYTES = 1 << 20
+
+# when set, all the basic monsters work out their moves together with array operations, instead of one by one
+BATCH_AI = True
+
+# monsters that find their way blocked by others look for a path around them, up to this many steps long
+ASTAR_MAX_PATH = 25
+
+# the game time one action of the player takes, and the speed at which an actor's turns come that often
+TURN_TIME = 100
+NORMAL_SPEED = 100
 
 MAX_ROOM_ITEMS = 2
 MAX_ROOM_MONSTERS = 3
+# the monsters' stats: hit points, defense and power
+ORC_HP = 10
+ORC_DEFENSE = 0
+ORC_POWER = 3
+TROLL_HP = 16
+TROLL_DEFENSE = 1
+TROLL_POWER = 4
+
+# the layers things on the map are drawn in, bottom first: the floor (the stairs, and the Decorations),
+# the items, then the actors, which is anything that fights or acts
+LAYER_FLOOR = 0
+LAYER_ITEMS = 1
+LAYER_ACTORS = 2
+
+# the bot (see BotInput) drinks a healing potion when its hit points drop below this part of the maximum
+BOT_HEAL_BELOW = 0.5
 # size of window
 SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
@@ -33,23 +64,49 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
-
-# create the list of game messages and their colors, starts empty
-game_msgs = []
+# how many messages the log keeps for the history view; older ones are dropped
+MSG_HISTORY = 5000
 
 LIMIT_FPS = 20 # 20 frames per second maximum
 
+# the profiler keeps this many of the latest timings of each phase, for the percentiles on the overlay
+PROFILE_WINDOW = 600
+# a trace file holds at most this many timings, the newest ones
+TRACE_MAX_EVENTS = 1000000
+
+# on a terminal, unchanged cells this close together are sent again rather than moving the cursor past them,
+# and an Escape key is told apart from the start of an escape sequence by nothing following it for this long
+ANSI_MERGE_GAP = 4
+ANSI_ESCAPE_DELAY = 0.05
+
 color_dark_wall = tcod.Color(0, 0, 100)
 color_light_wall = tcod.Color(130, 110, 50)
 color_dark_ground = tcod.Color(50, 50, 150)
 color_light_ground = tcod.Color(200, 180, 50)
 
+# the same colors as lookup tables, indexed by whether the tile blocks sight (0 = ground, 1 = wall)
+dark_colors = np.array([color_dark_ground, color_dark_wall], dtype=np.uint8)
+light_colors = np.array([color_light_ground, color_light_wall], dtype=np.uint8)
+
 font_path = 'arial10x10.png'
 font_flags = tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD
 
 window_title = 'pyrogue'
 fullscreen = False
 
+# when set, the game runs without a window: nothing is drawn and keys come from a script
+headless = False
+# the terminal the game is drawn on instead of a window, when it's played in one (see AnsiTerminal),
+# and the console that stands for the screen: the window's, or an off-screen one the terminal is sent
+terminal = None
+root = 0
+# builds the next dungeon levels in the background, when set up (see LevelPrefetcher)
+prefetcher = None
+# the overworld, when the game is played in one instead of the dungeon (see World)
+world = None
+# whether the timings of the main loop's phases are shown in the panel, instead of the messages
+show_profile = False
+
 player_x = SCREEN_WIDTH // 2
 player_y = SCREEN_HEIGHT // 2
 
@@ -57,6 +114,25 @@ ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6 
 MAX_ROOMS = 30
 
+# how many levels below the current one to build in the background, so going down the stairs doesn't stall
+PREFETCH_LEVELS = 1
+# a directory to keep the levels new games start on in, so a seed that was played before starts without
+# generating its level again (None to build them every time)
+LEVEL_CACHE_DIR = None
+
+# which dungeon generator make_map uses: 'rooms', 'bsp' or 'caves'
+MAP_GENERATOR = 'rooms'
+# for the caves: how much of the starting noise is wall, and how many times it's smoothed
+CAVE_WALL_CHANCE = 0.45
+CAVE_SMOOTHING_STEPS = 4
+
+# the overworld (see World): the size of its chunks, how many chunks across the map around the player is,
+# how many chunks are kept in memory besides those, and how many rooms a chunk tries to fit
+CHUNK_SIZE = 32
+WORLD_WINDOW = 3
+CHUNK_CACHE_SIZE = 64
+CHUNK_ROOMS = 4
+
 class Rect:
 	#a rectangle on the map. use to characterize a room.
 	def __init__(self, x, y, w, h):
@@ -75,44 +151,840 @@ class Rect:
 		return (self.x1 <= other.x2 and self.x2 >= other.x1 and
 			self.y1 <= other.y2 and self.y2 >= other.y1)
 			
-class Tile:
-	# a tile of the map and its properties
-	def __init__(self, blocked, block_sight = None):
+class Map:
+	# the tiles of the map, kept as boolean planes indexed [x, y] instead of one object per tile
+	def __init__(self, width, height, blocked=None, block_sight=None, explored=None):
+		self.width = width
+		self.height = height
+		# every tile starts out as solid rock: blocked, blocking sight and unexplored,
+		# unless the planes are given (e.g. when loading a saved game)
+		if blocked is None:
+			blocked = np.ones((width, height), dtype=bool, order='F')
+		if block_sight is None:
+			block_sight = np.ones((width, height), dtype=bool, order='F')
+		if explored is None:
+			explored = np.zeros((width, height), dtype=bool, order='F')
 		self.blocked = blocked
-		self.explored = False
-
-		# by default, if a tile is blocked, it also blocks sight
-		####### Try to understand this later ########
-		if block_sight is None: block_sight = blocked
 		self.block_sight = block_sight
+		self.explored = explored
+		# bumped whenever tiles change, so anything computed from them knows it's out of date
+		self.revision = 0
+
+	def carve(self, xs, ys):
+		# make a block of tiles (given as slices or indices) passable and see-through
+		self.blocked[xs, ys] = False
+		self.block_sight[xs, ys] = False
+		self.revision += 1
+
+# the eight steps a monster can take, as (dx, dy) rows
+DIRECTIONS = np.array([(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)], dtype=np.intp)
+
+class DistanceField:
+	# the number of steps from the tiles around the player to the player, shared by all the monsters chasing them.
+	# only monsters the player can see use it, so it covers the square the FOV can reach, plus the room
+	# move_astar gives paths around the sides; a tile outside it counts as unreachable. it's only rebuilt
+	# when the player moves or the tiles change
+	UNREACHABLE = np.iinfo(np.int32).max
+
+	def __init__(self):
+		self.key = None
+		self.distance = None
+		self.origin = (0, 0)   #the map position of the field's top left corner
+
+	def get(self):
+		key = (player.x, player.y, id(map), map.revision)
+		if key != self.key:
+			self.key = key
+			radius = (TORCH_RADIUS or max(map.width, map.height)) + ASTAR_MAX_PATH // 2
+			(x1, y1) = (max(player.x - radius, 0), max(player.y - radius, 0))
+			(x2, y2) = (min(player.x + radius + 1, map.width), min(player.y + radius + 1, map.height))
+			self.origin = (x1, y1)
+			self.distance = tcod.path.maxarray((x2 - x1, y2 - y1), dtype=np.int32, order='F')
+			self.distance[player.x - x1, player.y - y1] = 0
+			# walls can't be walked through, and diagonal steps take a turn just like straight ones
+			cost = (~map.blocked[x1:x2, y1:y2]).view(np.int8)
+			tcod.path.dijkstra2d(self.distance, cost, 1, 1, out=self.distance)
+		return self
+
+	def at(self, x, y):
+		# the distance from map position (x, y) to the player; x and y can be arrays of positions
+		(x1, y1) = self.origin
+		(width, height) = self.distance.shape
+		x = np.asarray(x) - x1
+		y = np.asarray(y) - y1
+		inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+		return np.where(inside, self.distance[np.clip(x, 0, width - 1), np.clip(y, 0, height - 1)], self.UNREACHABLE)
+
+def step_towards_player(x, y):
+	# the tile a monster at (x, y) should step onto to get closer to the player
+	field = player_field.get()
+	# the greedy step straight at the player, which is what monsters did before they could find paths
+	dx = player.x - x
+	dy = player.y - y
+	distance = math.sqrt(dx ** 2 + dy ** 2)
+	greedy = (x + int(round(dx / distance)), y + int(round(dy / distance)))
+
+	# otherwise, the neighbour closest to the player along the walkable tiles
+	best = greedy
+	for (step_x, step_y) in DIRECTIONS:
+		if field.at(x + step_x, y + step_y) < field.at(*best):
+			best = (x + int(step_x), y + int(step_y))
+	if field.at(*best) >= field.at(x, y):
+		return greedy   #no way to get closer (e.g. the player can't be reached), so just head straight at them
+	return best
+
+class SpatialIndex:
+	# keeps track of which objects stand on each tile, so lookups by position don't have to scan
+	# the whole objects list. each tile holds its objects in drawing order, bottom first: by layer,
+	# and within a layer in the order they came
+	def __init__(self):
+		self.tiles = {}
+
+	def add(self, obj):
+		stack = self.tiles.setdefault((obj.x, obj.y), [])
+		layer = obj.layer
+		i = len(stack)
+		while i and stack[i - 1].layer > layer:
+			i -= 1
+		stack.insert(i, obj)
+		dirty.mark(obj.x, obj.y)
+
+	def remove(self, obj):
+		dirty.mark(obj.x, obj.y)
+		key = (obj.x, obj.y)
+		stack = self.tiles[key]
+		stack.remove(obj)
+		if not stack:
+			del self.tiles[key]
+
+	def move(self, obj, x, y):
+		# change an object's position, keeping the index (and the objects in view) up to date
+		self.remove(obj)
+		obj.x = x
+		obj.y = y
+		self.add(obj)
+		visible.moved(obj)
+
+	def at(self, x, y):
+		# all the objects on a tile (an empty tuple if there are none)
+		return self.tiles.get((x, y), ())
+
+	def blocker_at(self, x, y):
+		for obj in self.at(x, y):
+			if obj.blocks:
+				return obj
+		return None
+
+	def fighter_at(self, x, y):
+		for obj in self.at(x, y):
+			if obj.fighter:
+				return obj
+		return None
+
+	def item_at(self, x, y):
+		for obj in self.at(x, y):
+			if obj.item:
+				return obj
+		return None
+
+	def near(self, x, y, radius):
+		# all the objects within a square of the given radius around (x, y)
+		if (2 * radius + 1) ** 2 > len(self.tiles):
+			# fewer occupied tiles than tiles in the square, so it's cheaper to go through them instead
+			for (ox, oy), stack in self.tiles.items():
+				if abs(ox - x) <= radius and abs(oy - y) <= radius:
+					yield from stack
+		else:
+			for ox in range(x - radius, x + radius + 1):
+				for oy in range(y - radius, y + radius + 1):
+					yield from self.at(ox, oy)
+
+# what a tile of the floor shows, for things that lie there and never do anything else (see Decorations)
+Decoration = collections.namedtuple('Decoration', ['char', 'color', 'name'])
+
+class Decorations:
+	# the bottom layer of what's drawn: things lying on the floor that are only there to be seen, like the
+	# remains of monsters. each tile has at most one, the latest. they have no entity, never block, can't
+	# be picked up and aren't among the objects (or the objects in view), so however many pile up during a
+	# long fight, nothing that goes through the objects gets slower
+	def __init__(self):
+		self.tiles = {}   #(x, y) -> Decoration
+
+	def __iter__(self):
+		# (x, y, decoration) for every decorated tile
+		return ((x, y, decoration) for ((x, y), decoration) in self.tiles.items())
+
+	def add(self, x, y, char, color, name):
+		self.tiles[(x, y)] = Decoration(char, tuple(color), name)
+		dirty.mark(x, y)
+
+	def at(self, x, y):
+		return self.tiles.get((x, y))
+
+class VisibleObjects:
+	# the objects (besides the player) in the player's FOV as of the last time it was computed, nearest
+	# first, so whoever needs to know what's in view doesn't have to ask the FOV map object by object.
+	# objects that move before the next recompute are moved in or out of it (the distances stay relative
+	# to where the player was, though)
+	def __init__(self, objects=()):
+		self.entries = {obj: (player.distance_to(obj), obj.id, obj) for obj in objects}   #object -> its entry below
+		self.by_distance = sorted(self.entries.values())
+
+	def __contains__(self, obj):
+		return obj in self.entries
+
+	def __iter__(self):
+		return (obj for (_, _, obj) in self.by_distance)
+
+	def add(self, obj):
+		entry = (player.distance_to(obj), obj.id, obj)
+		self.entries[obj] = entry
+		bisect.insort(self.by_distance, entry)
+
+	def discard(self, obj):
+		entry = self.entries.pop(obj, None)
+		if entry is not None:
+			del self.by_distance[bisect.bisect_left(self.by_distance, entry)]
+
+	def moved(self, obj):
+		self.discard(obj)
+		if obj is not player and fov_map.fov[obj.x, obj.y]:
+			self.add(obj)
+
+	def within(self, max_range):
+		# the visible objects less than max_range + 1 away, nearest first
+		for (distance, _, obj) in self.by_distance:
+			if distance >= max_range + 1:
+				break
+			yield obj
+
+class DirtyRegions:
+	# keeps track of the cells of the map console that changed since they were last put on the screen,
+	# so only those have to be redrawn and blitted. they all lie in box, so on a big map only that part of it
+	# is looked at. it also remembers which tiles were colored last (see color_tiles)
+	def __init__(self, width, height):
+		self.cells = np.ones((width, height), dtype=bool, order='F')   #everything starts out dirty
+		self.box = (0, 0, width, height)   #(x1, y1, x2, y2) around all the dirty cells, or None if there are none
+		self.colored = None   #(x1, y1, x2, y2, map revision) the tile colors were last worked out for, None for nothing yet
+
+	def extend(self, x1, y1, x2, y2):
+		if self.box is not None:
+			(x1, y1) = (min(x1, self.box[0]), min(y1, self.box[1]))
+			(x2, y2) = (max(x2, self.box[2]), max(y2, self.box[3]))
+		self.box = (x1, y1, x2, y2)
+
+	def mark(self, x, y):
+		if 0 <= x < self.cells.shape[0] and 0 <= y < self.cells.shape[1]:
+			self.cells[x, y] = True
+			self.extend(x, y, x + 1, y + 1)
+
+	def mark_mask(self, mask, x=0, y=0):
+		# mark the cells set in the mask, which covers the part of the map from (x, y)
+		(width, height) = mask.shape
+		self.cells[x:x + width, y:y + height] |= mask
+		self.extend(x, y, x + width, y + height)
+
+	def mark_all(self):
+		# everything has to be drawn again, the tile colors too
+		self.cells[:] = True
+		self.box = (0, 0) + self.cells.shape
+		self.colored = None
+
+	def spans(self, x, y, width, height):
+		# yield (y, x1, x2) for each dirty row inside the given rectangle, from its first to its last dirty cell
+		cells = self.cells[x:x + width, y:y + height]
+		for row in np.flatnonzero(cells.any(axis=0)):
+			xs = np.flatnonzero(cells[:, row])
+			yield y + int(row), x + int(xs[0]), x + int(xs[-1])
+
+	def clear(self):
+		if self.box is not None:
+			(x1, y1, x2, y2) = self.box
+			self.cells[x1:x2, y1:y2] = False
+			self.box = None
+
+class AnsiTerminal:
+	# draws the screen on a terminal with ANSI escape codes and 24-bit colors, for playing over SSH. it keeps
+	# a copy of the last frame it sent and only sends the cells that changed since, a run at a time, and
+	# only the colors that differ from the ones the terminal is already set to
+	def __init__(self, out):
+		self.out = out   #binary file the escape codes are written to
+		self.bytes_written = 0
+		self.invalidate()
+
+	def invalidate(self):
+		# forget what the terminal shows, so the next frame sends everything (e.g. after it was resized)
+		self.shown = None
+		self.cursor = None   #(x, y) where the next character will go, if known
+		self.colors = (None, None)   #the foreground and background the terminal is set to
+
+	def start(self):
+		# switch to the terminal's alternate screen, so the shell's is back when the game ends, and hide the cursor
+		self.write(b'\x1b[?1049h\x1b[?25l')
+		self.invalidate()
+
+	def close(self):
+		self.write(b'\x1b[0m\x1b[?25h\x1b[?1049l')
+		self.out.flush()
+
+	def write(self, data):
+		self.out.write(data)
+		self.bytes_written += len(data)
+
+	def flush(self, console):
+		# send what changed on the console (a C order one, of the size of the screen) since the last frame
+		frame = console.rgb.copy()
+		data = self.frame(frame)
+		if data:
+			self.write(data)
+		self.out.flush()
+		self.shown = frame
+
+	def frame(self, frame):
+		# the escape codes that turn the last frame sent into this one
+		if self.shown is None:
+			changed = np.ones(frame.shape, dtype=bool)
+			data = [b'\x1b[0m\x1b[2J']
+			self.colors = (None, None)
+		else:
+			changed = (frame['ch'] != self.shown['ch']) | (frame['bg'] != self.shown['bg']).any(axis=-1)
+			# the color of a blank only matters if it isn't blank anymore
+			changed |= (frame['fg'] != self.shown['fg']).any(axis=-1) & (frame['ch'] != ord(' '))
+			data = []
+		width = frame.shape[1]
+		for y in np.flatnonzero(changed.any(axis=1)):
+			xs = np.flatnonzero(changed[y])
+			# cells in between changed ones are sent again when that's shorter than moving the cursor past them
+			breaks = np.flatnonzero(np.diff(xs) > ANSI_MERGE_GAP)
+			for (x1, x2) in zip(np.r_[xs[0], xs[breaks + 1]], np.r_[xs[breaks], xs[-1]]):
+				if self.cursor != (x1, y):
+					data.append(b'\x1b[%d;%dH' % (y + 1, x1 + 1))
+				cells = frame[y, x1:x2 + 1]
+				for (ch, fg, bg) in zip(cells['ch'].tolist(), cells['fg'].tolist(), cells['bg'].tolist()):
+					data.append(self.cell(ch, tuple(fg), tuple(bg)))
+				# the cursor stays on the last column after writing there, instead of moving on
+				self.cursor = (int(x2) + 1, y) if x2 + 1 < width else None
+		return b''.join(data)
+
+	def cell(self, ch, fg, bg):
+		# one character, after whatever colors it needs that the terminal isn't set to already
+		(fg_now, bg_now) = self.colors
+		if ch == ord(' ') or ch == 0:
+			(ch, fg) = (ord(' '), fg_now)   #a blank shows only the background
+		codes = []
+		if fg != fg_now:
+			codes.append(b'38;2;%d;%d;%d' % fg)
+		if bg != bg_now:
+			codes.append(b'48;2;%d;%d;%d' % bg)
+		self.colors = (fg, bg)
+		if codes:
+			return b'\x1b[' + b';'.join(codes) + b'm' + chr(ch).encode()
+		return chr(ch).encode()
+
+# a key press that didn't come from the keyboard, with the same fields the game reads from tcod's keys
+ScriptedKey = collections.namedtuple('ScriptedKey', ['vk', 'c', 'lalt'], defaults=[False])
+
+# names for the special keys a script can press, everything else is a single character
+KEY_NAMES = {
+	'UP': tcod.KEY_UP,
+	'DOWN': tcod.KEY_DOWN,
+	'LEFT': tcod.KEY_LEFT,
+	'RIGHT': tcod.KEY_RIGHT,
+	'PAGEUP': tcod.KEY_PAGEUP,
+	'PAGEDOWN': tcod.KEY_PAGEDOWN,
+	'ENTER': tcod.KEY_ENTER,
+	'ESCAPE': tcod.KEY_ESCAPE,
+}
+
+# what a terminal sends for the special keys. Ctrl+C quits, since the terminal is in raw mode
+ANSI_KEYS = {
+	b'\x1b[A': 'UP',
+	b'\x1b[B': 'DOWN',
+	b'\x1b[C': 'RIGHT',
+	b'\x1b[D': 'LEFT',
+	b'\x1bOA': 'UP',
+	b'\x1bOB': 'DOWN',
+	b'\x1bOC': 'RIGHT',
+	b'\x1bOD': 'LEFT',
+	b'\x1b[5~': 'PAGEUP',
+	b'\x1b[6~': 'PAGEDOWN',
+	b'\x1b\r': 'ALT+ENTER',
+	b'\r': 'ENTER',
+	b'\n': 'ENTER',
+	b'\x03': 'ESCAPE',
+}
+
+def scripted_key(name):
+	# turn a key name ('UP', 'ESCAPE', ...) or a single character into a key. 'ALT+ENTER' holds down Alt,
+	# and '#<code>' is any other key with that tcod key code
+	if name == 'ALT+ENTER':
+		return ScriptedKey(tcod.KEY_ENTER, 0, True)
+	if name in KEY_NAMES:
+		return ScriptedKey(KEY_NAMES[name], 0)
+	if name.startswith('#') and name[1:].isdigit():
+		return ScriptedKey(int(name[1:]), 0)
+	if len(name) != 1:
+		raise ValueError('Unknown key: %r' % name)
+	return ScriptedKey(tcod.KEY_CHAR, ord(name))
+
+def key_name(key):
+	# the name scripted_key turns back into a key the game treats the same way
+	for (name, vk) in KEY_NAMES.items():
+		if key.vk == vk:
+			return 'ALT+' + name if name == 'ENTER' and key.lalt else name
+	if key.c >= ord(' '):
+		return chr(key.c)
+	return '#%d' % key.vk
+
+class InputPending(Exception):
+	# raised by an input source that has no key yet and can't wait for one (see play_turn)
+	pass
+
+class KeyboardInput:
+	# reads keys from the game window
+	def wait_for_key(self):
+		return tcod.console_wait_for_keypress(True)
+
+	def is_closed(self):
+		return tcod.console_is_window_closed()
+
+class TerminalInput:
+	# reads keys from a terminal (or anything else sending the same bytes, like a pseudo-terminal), in raw
+	# mode so every key press comes through as it happens. the arrow keys and the like arrive as escape
+	# sequences, which are turned back into the keys they stand for
+	def __init__(self, fd):
+		self.fd = fd
+		self.buffer = b''
+		self.closed = False
+
+	def wait_for_key(self):
+		while True:
+			(name, size) = decode_key(self.buffer)
+			if name is not None:
+				self.buffer = self.buffer[size:]
+				return scripted_key(name)
+			if self.closed:
+				return scripted_key('ESCAPE')
+			#a lone Escape can't be told apart from the start of a sequence, unless nothing else follows it soon
+			if self.buffer == b'\x1b' and not select.select([self.fd], [], [], ANSI_ESCAPE_DELAY)[0]:
+				self.buffer = b''
+				return scripted_key('ESCAPE')
+			data = os.read(self.fd, 1024)
+			if not data:
+				self.closed = True
+			self.buffer += data
+
+	def is_closed(self):
+		return self.closed and not self.buffer
+
+def decode_key(data):
+	# the name of the first key in the bytes a terminal sent, and how many bytes it took up. None if there's
+	# not enough of it yet. keys and sequences the game doesn't know come out as a key it ignores
+	if not data:
+		return None, 0
+	for (sequence, name) in ANSI_KEYS.items():
+		if data.startswith(sequence):
+			return name, len(sequence)
+	if data[:1] == b'\x1b':
+		if len(data) == 1 or (data[1:2] in b'[O' and len(data) == 2):
+			return None, 0
+		if data[1:2] not in b'[O':
+			return decode_key(data[1:])   #Alt and a key: the game only cares about Alt+Enter
+		# an unknown sequence ends with its first letter (or ~), after the parameters
+		for (i, byte) in enumerate(data[2:], 2):
+			if 0x40 <= byte <= 0x7e:
+				return '#0', i + 1
+		return None, 0
+	if data[0] >= 0x80:
+		return '#0', 1   #the game only has keys for plain characters
+	return chr(data[0]), 1
+
+class ScriptedInput:
+	# plays back a sequence of keys (names or ScriptedKeys), then presses Escape to end the game
+	def __init__(self, keys):
+		self.keys = iter(keys)
+
+	def wait_for_key(self):
+		key = next(self.keys, 'ESCAPE')
+		if isinstance(key, str):
+			key = scripted_key(key)
+		return key
+
+	def is_closed(self):
+		return False
+
+class RecordingInput:
+	# passes keys through from another input source, keeping a log of them so the game can be replayed
+	def __init__(self, source):
+		self.source = source
+		self.keys = []
+
+	def wait_for_key(self):
+		key = self.source.wait_for_key()
+		self.keys.append(key_name(key))
+		return key
+
+	def is_closed(self):
+		return self.source.is_closed()
+
+class BotInput:
+	# plays the game by itself, for trying out balance changes (see balance.py). it drinks a potion when
+	# it's hurt, zaps and confuses monsters with its scrolls, fights whatever it sees, picks up items,
+	# explores, and takes the stairs down when there's nothing left to explore. after max_turns keys,
+	# or once it's dead, it presses Escape
+	def __init__(self, max_turns=1000):
+		self.max_turns = max_turns
+		self.turns = 0
+		self.pending = collections.deque()   #keys it already decided on, like the letter to pick in a menu
+
+	def wait_for_key(self):
+		if not self.pending:
+			self.turns += 1
+			if self.turns > self.max_turns or game_state != 'playing':
+				self.pending.append('ESCAPE')
+			else:
+				self.pending.extend(self.decide())
+		return scripted_key(self.pending.popleft())
+
+	def is_closed(self):
+		return False
+
+	def decide(self):
+		# the keys for the next thing to do
+		enemies = [object for object in visible if object.fighter]
+		if player.fighter.hp < player.fighter.max_hp * BOT_HEAL_BELOW and self.has('healing potion'):
+			return self.use('healing potion')
+		if enemies:
+			target = enemies[0]
+			if len(enemies) > 1 and target.distance_to(player) < 2 and self.has('scroll of confusion'):
+				return self.use('scroll of confusion')
+			if target.fighter.hp > player.fighter.power and player.distance_to(target) <= LIGHTNING_RANGE and \
+					self.has('scroll of lightning bolt'):
+				return self.use('scroll of lightning bolt')
+			return self.step_towards(self.at(target)) or ['.']
+
+		if object_index.item_at(player.x, player.y) is not None and len(inventory) < 26:
+			return ['g']
+		items = [object for object in visible if object.item]
+		if items and len(inventory) < 26:
+			step = self.step_towards(self.at(items[0]))
+			if step:
+				return step
+
+		# the floor that hasn't been seen yet and can be reached, or else the stairs
+		step = self.step_towards(~map.blocked & ~map.explored)
+		if step:
+			return step
+		if stairs is not None and (stairs.x, stairs.y) == (player.x, player.y):
+			return ['>']
+		if stairs is not None:
+			return self.step_towards(self.at(stairs)) or ['.']
+		return ['.']   #nothing to do, wait
+
+	def has(self, name):
+		return any(item.name == name for item in inventory)
+
+	def use(self, name):
+		index = [item.name for item in inventory].index(name)
+		return ['i', chr(ord('a') + index)]
+
+	def at(self, object):
+		goal = np.zeros_like(map.blocked)
+		goal[object.x, object.y] = True
+		return goal
+
+	def step_towards(self, goals):
+		# the arrow key one step closer to the nearest goal tile, walking only in the four directions the
+		# player can, or None if there's no way there. monsters in the way get attacked, which is what
+		# moving into them does
+		distance = tcod.path.maxarray((map.width, map.height), dtype=np.int32, order='F')
+		distance[goals] = 0
+		tcod.path.dijkstra2d(distance, (~map.blocked).view(np.int8), 1, 0, out=distance)
+		best = None
+		for (key, dx, dy) in (('LEFT', -1, 0), ('RIGHT', 1, 0), ('UP', 0, -1), ('DOWN', 0, 1)):
+			(x, y) = (player.x + dx, player.y + dy)
+			if 0 <= x < map.width and 0 <= y < map.height and distance[x, y] < distance[player.x, player.y]:
+				if best is None or distance[x, y] < distance[best[1], best[2]]:
+					best = (key, x, y)
+		return [best[0]] if best else None
+
+def make_rng(seed, stream):
+	# an independent random number generator for one part of the game (map, spawn or ai), derived from
+	# the game's seed, so that e.g. a change in how monsters move doesn't change the maps you get
+	stream_seed = zlib.crc32(('%d:%s' % (seed, stream)).encode())
+	return tcod.random.Random(tcod.random.MERSENNE_TWISTER, stream_seed)
+
+def seed_rngs(seed):
+	global game_seed, ai_rng
+	game_seed = seed
+	ai_rng = make_rng(seed, 'ai')
+
+def seed_level_rngs(level):
+	# every dungeon level gets its own map and spawn streams, so a level is the same no matter
+	# when (or in which process) it's built
+	global map_rng, spawn_rng
+	map_rng = make_rng(game_seed, 'map:%d' % level)
+	spawn_rng = make_rng(game_seed, 'spawn:%d' % level)
+
+def save_replay(path, keys):
+	# everything needed to play the game again exactly: the seed, the map generator (or the overworld)
+	# and every key pressed
+	with open(path, 'w') as f:
+		json.dump({'version': 1, 'seed': game_seed, 'generator': MAP_GENERATOR, 'overworld': world is not None,
+			'keys': keys}, f)
+
+def load_replay(path):
+	with open(path) as f:
+		replay = json.load(f)
+	if replay.get('version') != 1:
+		raise ValueError('Unsupported replay version: %r' % replay.get('version'))
+	return replay['seed'], replay.get('generator', 'rooms'), replay.get('overworld', False), replay['keys']
+
+class LogEntry:
+	# one message in the log, with how many times in a row it was sent
+	__slots__ = ('text', 'color', 'count', 'wrapped')
+
+	def __init__(self, text, color, count=1):
+		self.text = text
+		self.color = color
+		self.count = count
+		self.wrapped = {}   #width -> lines, filled in when the message is shown
+
+	def lines(self, width):
+		# the message split into lines that fit the given width
+		if width not in self.wrapped:
+			text = self.text
+			if self.count > 1:
+				text += ' x' + str(self.count)
+			self.wrapped[width] = textwrap.wrap(text, width)
+		return self.wrapped[width]
+
+class MessageLog:
+	# the game messages, in a ring buffer of fixed size so old ones fall off without anything being moved.
+	# messages are kept as they were sent and only wrapped when they're shown, and a message repeated
+	# right after itself just bumps a counter ("Orc attacks player x5")
+	def __init__(self, capacity=MSG_HISTORY):
+		self.entries = collections.deque(maxlen=capacity)
+		# bumped every time a message is added, so the panel knows when it has to be redrawn
+		self.revision = 0
+
+	def add(self, text, color, count=1):
+		last = self.entries[-1] if self.entries else None
+		if last is not None and last.text == text and last.color == color:
+			last.count += count
+			last.wrapped = {}
+		else:
+			self.entries.append(LogEntry(text, color, count))
+		self.revision += 1
+
+	def lines(self, width, height, offset=0):
+		# up to `height` wrapped (line, color) pairs, oldest first, ending `offset` lines before the newest one.
+		# only the messages that end up on screen get wrapped
+		lines = []
+		for entry in reversed(self.entries):
+			for line in reversed(entry.lines(width)):
+				if offset > 0:
+					offset -= 1
+					continue
+				lines.append((line, entry.color))
+				if len(lines) == height:
+					return lines[::-1]
+		return lines[::-1]
+
+	def __len__(self):
+		return len(self.entries)
+
+class Profiler:
+	# times the phases of every turn (rendering, flushing, input, the monsters' turns) and their parts.
+	# the last PROFILE_WINDOW timings of each phase are kept for the percentiles the overlay shows, and
+	# when tracing, every timing is also kept as an event for a Chrome trace file (chrome://tracing, Perfetto)
+	def __init__(self, window=PROFILE_WINDOW):
+		self.window = window
+		self.samples = {}   #phase name -> its latest durations, in seconds
+		self.events = None   #trace events, when tracing
+		self.start = time.perf_counter()
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, start, time.perf_counter() - start)
+
+	def record(self, name, start, duration):
+		# add a timing that was measured elsewhere, starting at the given perf_counter() time
+		if name not in self.samples:
+			self.samples[name] = collections.deque(maxlen=self.window)
+		self.samples[name].append(duration)
+		if self.events is not None:
+			self.events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': 1,
+				'ts': (start - self.start) * 1e6, 'dur': duration * 1e6})
+
+	def percentiles(self, name, points=(50, 95, 99)):
+		# the given percentiles of a phase's recent timings, in seconds
+		return np.percentile(self.samples[name], points)
+
+	def report(self):
+		# the percentiles and worst time of every phase, in milliseconds
+		return {name: dict(zip(['p50', 'p95', 'p99'], (self.percentiles(name) * 1000).tolist()),
+			max=max(samples) * 1000, count=len(samples)) for (name, samples) in self.samples.items()}
+
+	def start_trace(self, max_events=TRACE_MAX_EVENTS):
+		# only the newest events are kept, so a long session doesn't run out of memory
+		self.events = collections.deque(maxlen=max_events)
+
+	def write_trace(self, path):
+		with open(path, 'w') as f:
+			json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+profiler = Profiler()
+
+class EntityStore:
+	# the data of every entity (the player, monsters, items, the stairs...) in typed arrays indexed by the
+	# entity's id, instead of in a dict per object. Object and its components are thin views into these
+	# arrays, and the passes over all the entities (drawing, AI, saving) can work on the arrays directly.
+	# the ids of destroyed entities are reused by new ones.
+	ARRAYS = ['x', 'y', 'char', 'color', 'blocks', 'hp', 'max_hp', 'defense', 'power', 'ai_kind', 'speed']
+
+	def __init__(self, capacity=64):
+		self.x = np.zeros(capacity, dtype=np.int32)
+		self.y = np.zeros(capacity, dtype=np.int32)
+		self.char = np.zeros(capacity, dtype=np.uint32)
+		self.color = np.zeros((capacity, 3), dtype=np.uint8)
+		self.blocks = np.zeros(capacity, dtype=bool)
+		self.hp = np.zeros(capacity, dtype=np.int32)
+		self.max_hp = np.zeros(capacity, dtype=np.int32)
+		self.defense = np.zeros(capacity, dtype=np.int32)
+		self.power = np.zeros(capacity, dtype=np.int32)
+		self.ai_kind = np.zeros(capacity, dtype=np.uint8)   #position of the AI's class in AI_CLASSES, 0 for none
+		self.speed = np.zeros(capacity, dtype=np.uint16)
+		self.name = [None] * capacity
+		self.size = 0   #ids below this have been handed out
+		self.free = []
+
+	def create(self):
+		# a new entity id, with all its data zeroed
+		if self.free:
+			return self.free.pop()
+		if self.size == len(self.x):
+			self.grow()
+		self.size += 1
+		return self.size - 1
+
+	def destroy(self, id):
+		for name in self.ARRAYS:
+			getattr(self, name)[id] = 0
+		self.name[id] = None
+		self.free.append(id)
+
+	def grow(self):
+		# double the capacity of every array, keeping what's in them
+		capacity = 2 * len(self.x)
+		for name in self.ARRAYS:
+			old = getattr(self, name)
+			new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+			new[:len(old)] = old
+			setattr(self, name, new)
+		self.name += [None] * (capacity - len(self.name))
+
+class EntityField:
+	# an attribute that lives in one of the entity store's arrays, at the id of the object it's read from,
+	# converted on the way out (and optionally on the way in)
+	def __init__(self, array, get=None, set=None):
+		self.array = array
+		self.get = get
+		self.set = set
+
+	def __get__(self, obj, objtype=None):
+		if obj is None:
+			return self
+		value = getattr(entities, self.array)[obj.id]
+		return value if self.get is None else self.get(value)
+
+	def __set__(self, obj, value):
+		getattr(entities, self.array)[obj.id] = value if self.set is None else self.set(value)
 
 class Object:
 	# this is a generic object: the player, a monster, an item, the stairs, etc.
 	# it's always represented by a character on the screen.
-	def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None):
+	# the object only holds its id and components, the rest is in the entity store
+	__slots__ = ('id', 'fighter', '_ai', 'item')
+
+	x = EntityField('x', int)
+	y = EntityField('y', int)
+	char = EntityField('char', chr, ord)
+	color = EntityField('color', lambda color: tcod.Color(*color.tolist()))
+	blocks = EntityField('blocks', bool)
+	name = EntityField('name')
+	speed = EntityField('speed', int)   #how often it gets a turn, NORMAL_SPEED being once per turn of the player
+
+	def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None, speed=NORMAL_SPEED):
+		self.id = entities.create()
 		self.name = name
 		self.blocks = blocks
+		self.speed = speed
 		self.x = x
 		self.y = y
 		self.char = char
 		self.color = color
 		self.fighter = fighter
 		if self.fighter:   # let the fighter component know who owns it
-			self.fighter.owner = self
+			self.fighter.attach(self)
 		self.ai = ai
-		if self.ai:   # let the AI component know who owns it
-			self.ai.owner = self
 		self.item = item
 		if self.item:   #let the Item component know who owns it
 			self.item.owner = self
 
+	@property
+	def ai(self):
+		return self._ai
+
+	@ai.setter
+	def ai(self, ai):
+		self._ai = ai
+		if ai:   # let the AI component know who owns it
+			ai.owner = self
+			entities.ai_kind[self.id] = AI_CLASSES.index(type(ai))
+		else:
+			entities.ai_kind[self.id] = 0
+
+	def destroy(self):
+		# give the object's id back to the entity store. the object must not be used after this
+		entities.destroy(self.id)
+
 	def move(self, dx, dy):
 		# move by the given amount, if the destination is not blocked
 		#if not map[self.x + dx][self.y + dy].blocked:
 		if not is_blocked(self.x + dx, self.y + dy):
-			self.x += dx
-			self.y += dy
+			object_index.move(self, self.x + dx, self.y + dy)
+
+	def place(self, x, y):
+		# put the object at the given position, no matter what's there
+		object_index.move(self, x, y)
 	
+	def move_astar(self, target):
+		# take one step along the shortest path to the target, going around any other blocking objects.
+		# only a window around the two of them is searched, since long detours aren't worth it anyway
+		x1 = max(min(self.x, target.x) - ASTAR_MAX_PATH // 2, 0)
+		y1 = max(min(self.y, target.y) - ASTAR_MAX_PATH // 2, 0)
+		x2 = min(max(self.x, target.x) + ASTAR_MAX_PATH // 2 + 1, map.width)
+		y2 = min(max(self.y, target.y) + ASTAR_MAX_PATH // 2 + 1, map.height)
+		cost = (~map.blocked[x1:x2, y1:y2]).astype(np.int8)
+		for ((x, y), stack) in object_index.tiles.items():
+			if x1 <= x < x2 and y1 <= y < y2 and any(obj.blocks for obj in stack):
+				cost[x - x1, y - y1] = 0
+		cost[self.x - x1, self.y - y1] = 1
+		cost[target.x - x1, target.y - y1] = 1   #the target itself is the goal, not an obstacle
+
+		graph = tcod.path.SimpleGraph(cost=cost, cardinal=1, diagonal=1)
+		pathfinder = tcod.path.Pathfinder(graph)
+		pathfinder.add_root((self.x - x1, self.y - y1))
+		path = pathfinder.path_to((target.x - x1, target.y - y1))[1:]
+		if 0 < len(path) < ASTAR_MAX_PATH:
+			(x, y) = path[0]
+			self.move(int(x) + x1 - self.x, int(y) + y1 - self.y)
+
 	def move_towards(self, target_x, target_y):
 		# vector from this object to the target, and distance
 		dx = target_x - self.x
@@ -125,37 +997,42 @@ class Object:
 		dy = int(round(dy / distance))
 		self.move(dx, dy)
 
-	def draw(self):
-		if tcod.map_is_in_fov(fov_map, self.x, self.y):    # check fov before drawing
-			# set the color and then draw the character that represented this object at its position
-			tcod.console_set_default_foreground(con, self.color)
-			tcod.console_put_char(con, self.x, self.y, self.char, tcod.BKGND_NONE)
-
-	def clear(self):
-		# erase the character that represents this object
-		tcod.console_put_char(con, self.x, self.y, ' ', tcod.BKGND_NONE)
-
 	def distance_to(self, other):
 		#return the ditance to another object
 		dx = other.x - self.x
 		dy = other.y - self.y
 		return math.sqrt(dx ** 2 + dy ** 2)
 	
-	def send_to_back(self):
-		# make this object be drawn first, so all others appear above it if they're in the same tile
-		global objects
-		objects.remove(self)
-		objects.insert(0, self)
+	@property
+	def layer(self):
+		# the layer it's drawn in: anything that fights or acts goes over the items, which go over the floor
+		if self.fighter or self.ai:
+			return LAYER_ACTORS
+		if self.item:
+			return LAYER_ITEMS
+		return LAYER_FLOOR
 
 class Fighter:
 	#combat-related properties and methods (monster, player, NPC)
+	# the stats are kept in the entity store, under the owner's id
+	__slots__ = ('id', 'owner', 'death_function', 'stats')
+
+	hp = EntityField('hp', int)
+	max_hp = EntityField('max_hp', int)
+	defense = EntityField('defense', int)
+	power = EntityField('power', int)
+
 	def __init__(self, hp, defense, power, death_function=None):
-		self.max_hp = hp
-		self.hp = hp
-		self.defense = defense
-		self.power = power
+		self.stats = (hp, defense, power)   #until there's an owner to store them under
 		self.death_function = death_function
 
+	def attach(self, owner):
+		self.owner = owner
+		self.id = owner.id
+		(self.hp, self.defense, self.power) = self.stats
+		self.max_hp = self.hp
+		self.stats = None
+
 	def take_damage(self, damage):
 		# apply damage if possible
 		if damage > 0:
@@ -184,34 +1061,61 @@ class Fighter:
 
 class BasicMonster:
 	#AI for a basic monster
+	__slots__ = ('owner',)
+
 	def take_turn(self):
 		# a basic monster takes its turn. If you can see it, it can see you.
 		monster = self.owner
-		if tcod.map_is_in_fov(fov_map, monster.x, monster.y):
+		if monster in visible:
 			# move towards the player if far away
 			if monster.distance_to(player) >= 2:
-				monster.move_towards(player.x, player.y)
+				(x, y) = step_towards_player(monster.x, monster.y)
+				if map.blocked[x, y]:
+					pass
+				elif object_index.blocker_at(x, y) is not None:
+					monster.move_astar(player)   #another monster is in the way, try to get around it
+				else:
+					object_index.move(monster, x, y)
 
 			# close enough, attack! (if the player is still alive)
 			elif player.fighter.hp > 0:
 				monster.fighter.attack(player)
 
+	def dormant(self):
+		# out of sight it has nothing to do, so it can sleep until the player sees it again
+		return self.owner not in visible
+
 class ConfusedMonster:
-	#AI for a temporarily confused monster (reverts to previous AI after awhile).
+	#AI for a temporarily confused monster (reverts to previous AI after awhile, when the scheduler calls recover).
+	__slots__ = ('owner', 'old_ai', 'until')
+
 	def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
 		self.old_ai = old_ai
-		self.num_turns = num_turns
+		self.until = scheduler.now + num_turns * TURN_TIME   #the game time it wears off
 
 	def take_turn(self):
-		if self.num_turns > 0:   #still confused
-			#move in a random direction, and decrease the number of turns confused
-			self.owner.move(tcod.random_get_int(0, -1, 1), tcod.random_get_int(0, -1, 1))
-			self.num_turns -= 1
+		#move in a random direction
+		self.owner.move(tcod.random_get_int(ai_rng, -1, 1), tcod.random_get_int(ai_rng, -1, 1))
+
+	def dormant(self):
+		return False
 
-		else:   #restore the previous AI (this one will be deleted because it's not referenced anymore
+	def turns_left(self):
+		return max(0, -(-(self.until - scheduler.now) // TURN_TIME))
+
+	def recover(self):
+		#restore the previous AI (this one will be deleted because it's not referenced anymore),
+		#unless the monster died, or was confused again and its time was put off
+		if self.owner.ai is self and self.until <= scheduler.now:
 			self.owner.ai = self.old_ai
 			message('The ' + self.owner.name + ' is no longer confused!', tcod.red)
+
+# the kinds of AI, as the entity store (and save files) keep them
+AI_CLASSES = [None, BasicMonster, ConfusedMonster]
+
 class Item:
+	__slots__ = ('owner', 'use_function')
+
 	def __init__(self, use_function=None):
 		self.use_function = use_function
 	def use(self):
@@ -220,7 +1124,9 @@ class Item:
 			message('The ' + self.ower.name + ' cannot be used.')
 		else:
 			if self.use_function() != 'cancelled':
+				game_stats['items used'] += 1
 				inventory.remove(self.owner)  #destroy after use, unless it was cancelled for some reason
+				self.owner.destroy()
 
 	#an item that can be picked up and used.
 	def pick_up(self):
@@ -229,36 +1135,138 @@ class Item:
 			message('Your inventory is full, cannot pick up' + self.owner.name + '.', tcod.red)
 		else:
 			inventory.append(self.owner)
-			objects.remove(self.owner)
+			remove_object(self.owner)
 			message('You picked up a ' + self.owner.name + '!', tcod.green)
 			
+class Scheduler:
+	# decides who acts when. the actors that are awake wait in a heap ordered by the game time of their next
+	# turn, along with timed events (like a monster coming out of its confusion). every action of the player
+	# takes TURN_TIME, and an actor's turn takes TURN_TIME * NORMAL_SPEED / its speed, so faster actors get
+	# more turns. an actor whose AI is dormant after its turn isn't put back in the heap, and costs nothing
+	# until it's woken up again. at the same time, events go before turns, and turns go in the order the
+	# actors were first scheduled in (which is the order of the objects list)
+	def __init__(self):
+		self.now = 0
+		self.event_count = 0
+		self.clear()
+
+	def clear(self):
+		# forget every actor and event (when the map is replaced), keeping the clock
+		self.heap = []
+		self.entries = {}   #the heap entry of every actor that's awake
+		self.order = {}   #the position of every actor seen so far, for ties
+
+	def wake(self, actor, time=None):
+		# give an actor a turn at the given time (now by default), unless it already has one coming
+		if actor in self.entries:
+			return
+		if actor not in self.order:
+			self.order[actor] = len(self.order)
+		entry = [self.now if time is None else time, 1, self.order[actor], actor]
+		self.entries[actor] = entry
+		heapq.heappush(self.heap, entry)
+
+	def sleep(self, actor):
+		# take back an actor's turn, if it has one. its entry stays in the heap, but empty
+		entry = self.entries.pop(actor, None)
+		if entry is not None:
+			entry[-1] = None
+
+	def call_at(self, time, function):
+		self.event_count += 1
+		heapq.heappush(self.heap, [time, 0, self.event_count, function])
+
+	def pop_due(self):
+		# the events and the actors due at the earliest time in the heap, if that's no later than now, as
+		# (time, actors, events). the actors are asleep until they're woken for their next turn
+		while self.heap and self.heap[0][-1] is None:
+			heapq.heappop(self.heap)
+		if not self.heap or self.heap[0][0] > self.now:
+			return None
+		time = self.heap[0][0]
+		actors = []
+		events = []
+		while self.heap and self.heap[0][0] == time:
+			(_, is_actor, _, payload) = heapq.heappop(self.heap)
+			if payload is None:
+				continue
+			if is_actor:
+				del self.entries[payload]
+				actors.append(payload)
+			else:
+				events.append(payload)
+		return time, actors, events
+
+def schedule_actor(actor):
+	# an actor on the map is awake until its first turn shows whether it has anything to do.
+	# if it's confused, it comes out of it when its time is up
+	scheduler.wake(actor)
+	if type(actor.ai) is ConfusedMonster:
+		scheduler.call_at(actor.ai.until, actor.ai.recover)
+
 def create_room(room):
 	global map
-	# go through the tiles in the rectangle and make them passable
-	for x in range(room.x1 + 1, room.x2):
-		for y in range(room.y1 + 1, room.y2):
-			map[x][y].blocked = False
-			map[x][y].block_sight = False
+	# make the tiles inside the rectangle passable, leaving its edges as walls
+	map.carve(slice(room.x1 + 1, room.x2), slice(room.y1 + 1, room.y2))
 
 def make_map():
 	global map
 
 	# fill map with "blocked" tiles
-	map = [
-		[Tile(True) for y in range(MAP_HEIGHT)]
-		for x in range (MAP_WIDTH)
-	]
-
+	map = Map(MAP_WIDTH, MAP_HEIGHT)
+
+	#let the generator carve out the dungeon; it returns the areas to put monsters and items in
+	rooms = MAP_GENERATORS[MAP_GENERATOR]()
+
+	#the player starts at the center of the first room
+	(x, y) = rooms[0].center()
+	player.place(x, y)
+
+	for room in rooms:
+		place_objects(room)
+
+	#the stairs down go in the last room
+	global stairs
+	(x, y) = floor_in_room(rooms[-1])
+	stairs = Object(x, y, '>', 'stairs', tcod.white)
+	add_object(stairs)
+
+def floor_in_room(room):
+	#the center of a room, or if that's a wall (as it can be in caves) the first floor tile inside it
+	(x, y) = room.center()
+	if not map.blocked[x, y]:
+		return x, y
+	(xs, ys) = np.nonzero(~map.blocked[room.x1 + 1:room.x2, room.y1 + 1:room.y2])
+	return room.x1 + 1 + int(xs[0]), room.y1 + 1 + int(ys[0])
+
+def connect_rooms(prev_room, new_room):
+	#connect two rooms with an L-shaped tunnel between their centers
+	(prev_x, prev_y) = prev_room.center()
+	(new_x, new_y) = new_room.center()
+
+	#flip a coint (random number that is either 0 or 1)
+	if tcod.random_get_int(map_rng, 0, 1) == 1:
+		#first move horizontally, then vertically
+		create_h_tunnel(prev_x, new_x, prev_y)
+		create_v_tunnel(prev_y, new_y, new_x)
+	else:
+		#first move vertically, then horizontally
+		create_v_tunnel(prev_y, new_y, prev_x)
+		create_h_tunnel(prev_x, new_x, new_y)
+
+def generate_rooms(max_rooms=None):
+	#the original generator: try MAX_ROOMS random rooms, keeping the ones that don't overlap
+	if max_rooms is None:
+		max_rooms = MAX_ROOMS
 	rooms = []
-	num_rooms = 0
 
-	for r in range(MAX_ROOMS):
+	for r in range(max_rooms):
 		#random width and height
-		w = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		w = tcod.random_get_int(map_rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		h = tcod.random_get_int(map_rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
 		#random position without going out of the boundaries of the map
-		x = tcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-		y = tcod.random_get_int(0, 0, MAP_HEIGHT- h - 1)
+		x = tcod.random_get_int(map_rng, 0, map.width - w - 1)
+		y = tcod.random_get_int(map_rng, 0, map.height - h - 1)
 		
 		#Rect class makes rectangles easier to work with
 		new_room = Rect(x, y, w, h)
@@ -276,129 +1284,405 @@ def make_map():
 			#"paint" it to the map's tiles
 			create_room(new_room)
 
-			#center coordinate of the new room, will be useful later
-			(new_x, new_y) = new_room.center()
-
-			if num_rooms == 0:
-				#this is the first room, where the player starts at
-				player.x = new_x
-				player.y = new_y
-
-			else:
-				#all roms after the first:
-				#connect it to the previous room with a tunnel
-
-				#center coordinate of the previous room
-				(prev_x, prev_y) = rooms[num_rooms-1].center()
-
-				#flip a coint (random number that is either 0 or 1)
-				if tcod.random_get_int(0, 0, 1) == 1:
-					#first move horizontally, then vertically
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
-				else:
-					#first move vertically, then horizontally
-					create_v_tunnel(prev_y, new_y, new_x)
-					create_h_tunnel(prev_x, new_x, new_y)
+			if rooms:
+				#all roms after the first: connect it to the previous room with a tunnel
+				connect_rooms(rooms[-1], new_room)
 
-			place_objects(new_room)
 			#finally, append the new room to the list
 			rooms.append(new_room)
-			num_rooms += 1
 
+	return rooms
+
+def generate_bsp():
+	#split the map in two again and again (binary space partitioning), and put one room in each of the
+	#final pieces. the pieces never overlap, so every room is kept, and there are as many as the map has space for
+	bsp = tcod.bsp.BSP(x=0, y=0, width=map.width, height=map.height)
+	#each piece needs space for the smallest room plus a wall
+	min_size = ROOM_MIN_SIZE + 1
+	depth = max(1, int(math.log2(map.width * map.height / (ROOM_MAX_SIZE + 1) ** 2)) + 1)
+	bsp.split_recursive(depth, min_size, min_size, 1.5, 1.5, seed=map_rng)
+
+	rooms = []
+	#the room each piece got (or one of its sub-pieces' rooms), to connect it to its sibling
+	node_rooms = {}
+	for node in bsp.post_order():
+		if node.children:
+			#connect the two halves through one room of each
+			(left, right) = node.children
+			connect_rooms(node_rooms[left], node_rooms[right])
+			node_rooms[node] = node_rooms[left]
+			continue
+
+		#a random room that fits inside this piece, leaving its last row and column for the wall between pieces
+		w = tcod.random_get_int(map_rng, min(ROOM_MIN_SIZE, node.width - 1), min(ROOM_MAX_SIZE, node.width - 1))
+		h = tcod.random_get_int(map_rng, min(ROOM_MIN_SIZE, node.height - 1), min(ROOM_MAX_SIZE, node.height - 1))
+		x = tcod.random_get_int(map_rng, node.x, node.x + node.width - 1 - w)
+		y = tcod.random_get_int(map_rng, node.y, node.y + node.height - 1 - h)
+		room = Rect(x, y, w, h)
+		create_room(room)
+		rooms.append(room)
+		node_rooms[node] = room
+
+	return rooms
+
+def label_regions(open):
+	#label the regions of the open tiles, where tiles touching on a side or a corner are in the same region.
+	#every tile's label is the smallest flat index in its region (-1 for tiles that aren't open). each pass
+	#joins neighbours with different labels to the smaller label, then follows the labels to their ends, so it
+	#takes a few passes over the map instead of one walk per region
+	index = np.arange(open.size).reshape(open.shape)
+	pairs = [(index[:-1, :], index[1:, :]), (index[:, :-1], index[:, 1:]),
+		(index[:-1, :-1], index[1:, 1:]), (index[:-1, 1:], index[1:, :-1])]
+	flat = open.ravel()
+	a = np.concatenate([first.ravel() for (first, second) in pairs])
+	b = np.concatenate([second.ravel() for (first, second) in pairs])
+	linked = flat[a] & flat[b]
+	(a, b) = (a[linked], b[linked])
+	labels = np.arange(open.size)
+	while True:
+		(la, lb) = (labels[a], labels[b])
+		differ = la != lb
+		if not differ.any():
+			break
+		(a, b, la, lb) = (a[differ], b[differ], la[differ], lb[differ])
+		np.minimum.at(labels, np.maximum(la, lb), np.minimum(la, lb))
+		while True:
+			followed = labels[labels]
+			if np.array_equal(followed, labels):
+				break
+			labels = followed
+	labels[~flat] = -1
+	return labels.reshape(open.shape)
+
+def generate_caves():
+	#natural-looking caves from cellular automata: start with random noise, then repeatedly turn each tile
+	#into a wall if most of its neighbours are walls. each step works on the whole map at once
+	(width, height) = (map.width, map.height)
+	noise = np.random.default_rng(tcod.random_get_int(map_rng, 0, 0x7FFFFFFF))
+	wall = noise.random((width, height)) < CAVE_WALL_CHANCE
+
+	for step in range(CAVE_SMOOTHING_STEPS):
+		#the edges of the map are always walls
+		wall[[0, -1], :] = True
+		wall[:, [0, -1]] = True
+		#count the walls in the 3x3 square around every tile, by adding up the map shifted in all 9 directions
+		padded = np.pad(wall, 1, constant_values=True).view(np.uint8)
+		walls = sum(padded[dx:dx + width, dy:dy + height] for dx in range(3) for dy in range(3))
+		wall = walls >= 5
+	wall[[0, -1], :] = True
+	wall[:, [0, -1]] = True
+
+	#keep only the biggest cave, so every tile can be reached, and fill in the rest. the caves are labelled
+	#all at once, then looked at starting from random floor tiles that aren't in a cave looked at yet, until
+	#one has half the floor. finding the tile is a count over blocks of about sqrt(floor) tiles, so it stays
+	#cheap when the walls break the floor up into thousands of small caves
+	floor = ~wall
+	labels = label_regions(floor).ravel()
+	cells = np.flatnonzero(floor)   #the floor tiles, in the order np.nonzero lists them
+	cell_labels = labels[cells]
+	by_cave = np.argsort(cell_labels, kind='stable')   #the floor tiles of each cave together
+	(cave_labels, cave_starts, cave_sizes) = np.unique(cell_labels[by_cave], return_index=True, return_counts=True)
+	block = max(1, math.isqrt(len(cells)))
+	unvisited = np.ones(len(cells), dtype=bool)
+	unvisited_per_block = np.bincount(np.arange(len(cells)) // block)
+	left = len(cells)
+	(cave_label, cave_size) = (None, 0)
+	while cave_size * 2 < len(cells) and left:
+		i = tcod.random_get_int(map_rng, 0, left - 1)
+		#the i-th floor tile not visited yet: first its block, then its place in the block
+		ends = np.cumsum(unvisited_per_block)
+		b = int(np.searchsorted(ends, i, side='right'))
+		i -= int(ends[b - 1]) if b else 0
+		label = cell_labels[b * block + np.flatnonzero(unvisited[b * block:(b + 1) * block])[i]]
+		c = np.searchsorted(cave_labels, label)
+		members = by_cave[cave_starts[c]:cave_starts[c] + cave_sizes[c]]
+		unvisited[members] = False
+		unvisited_per_block -= np.bincount(members // block, minlength=len(unvisited_per_block))
+		left -= len(members)
+		if len(members) > cave_size:
+			(cave_label, cave_size) = (label, len(members))
+	cave = np.zeros_like(floor)
+	if cave_label is not None:
+		cave = (labels == cave_label).reshape(floor.shape)
+	map.carve(*np.nonzero(cave))
+
+	#caves have no rooms, so monsters and items go in the squares of a grid over the map (place_objects skips
+	#the walls). the player starts in a tiny "room" around a random cave tile
+	(xs, ys) = np.nonzero(cave)
+	i = tcod.random_get_int(map_rng, 0, len(xs) - 1)
+	rooms = [Rect(int(xs[i]) - 1, int(ys[i]) - 1, 2, 2)]
+	size = ROOM_MAX_SIZE
+	for x in range(0, width - 2, size):
+		for y in range(0, height - 2, size):
+			room = Rect(x, y, min(size, width - 1 - x), min(size, height - 1 - y))
+			if cave[room.x1 + 1:room.x2, room.y1 + 1:room.y2].any():
+				rooms.append(room)
+	return rooms
 
 def create_h_tunnel(x1, x2, y):
 	global map
-	for x in range(min(x1, x2), max(x1, x2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	map.carve(slice(min(x1, x2), max(x1, x2) + 1), y)
 
 def create_v_tunnel(y1, y2, x):
 	global map
-	for y in range(min(y1, y2), max(y1, y2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	map.carve(x, slice(min(y1, y2), max(y1, y2) + 1))
+
+# the ways make_map can lay out the dungeon, each carving the map and returning the rooms to populate
+MAP_GENERATORS = {
+	'rooms': generate_rooms,
+	'bsp': generate_bsp,
+	'caves': generate_caves,
+}
+
+class FovCache:
+	# the FOVs the player had lately, so stepping back onto a tile doesn't mean computing its FOV again.
+	# each one is kept as a bitset of the square the torch reaches, under everything the result depends on
+	# (position, radius, algorithm, map revision), and the least recently used ones are dropped when they
+	# add up to more than max_bytes. a different map empties it.
+	# only the square a FOV can reach is touched, so on a big map a cached FOV costs next to nothing
+	def __init__(self, max_bytes=FOV_CACHE_BYTES):
+		self.max_bytes = max_bytes
+		self.clear()
+
+	def clear(self):
+		self.entries = collections.OrderedDict()   #key -> (x1, y1, x2, y2, bits)
+		self.bytes = 0
+		self.map = None
+		self.shown = None   #the square the FOV array has its visible tiles in, if known
+
+	def window(self, x, y):
+		# the part of the map a FOV from (x, y) can reach
+		radius = TORCH_RADIUS or max(map.width, map.height)
+		return max(x - radius, 0), max(y - radius, 0), min(x + radius + 1, map.width), min(y + radius + 1, map.height)
+
+	def load(self, key, fov):
+		# fill in the FOV array from the cache, if it's there. returns whether it was
+		if self.map is not map:
+			self.clear()
+			self.map = map
+		entry = self.entries.get(key)
+		if entry is None:
+			return False
+		self.entries.move_to_end(key)
+		(x1, y1, x2, y2, bits) = entry
+		if self.shown is None:
+			fov[:] = False
+		else:
+			(sx1, sy1, sx2, sy2) = self.shown
+			fov[sx1:sx2, sy1:sy2] = False
+		fov[x1:x2, y1:y2] = np.unpackbits(bits, count=(x2 - x1) * (y2 - y1)).reshape((x2 - x1, y2 - y1))
+		self.shown = (x1, y1, x2, y2)
+		return True
+
+	def store(self, key, fov):
+		(x1, y1, x2, y2) = self.window(key[0], key[1])
+		bits = np.packbits(fov[x1:x2, y1:y2])
+		self.entries[key] = (x1, y1, x2, y2, bits)
+		self.shown = (x1, y1, x2, y2)
+		self.bytes += bits.nbytes
+		while self.bytes > self.max_bytes and len(self.entries) > 1:
+			(_, (_, _, _, _, old)) = self.entries.popitem(last=False)
+			self.bytes -= old.nbytes
+
+fov_cache = FovCache()
+
+def make_fov_map():
+	# create the FOV map from the tile planes in one go, instead of setting every cell
+	fov_map = tcod.map.Map(map.width, map.height, order='F')
+	fov_map.transparent[:] = ~map.block_sight
+	fov_map.walkable[:] = ~map.blocked
+	return fov_map
 		
 def render_all():
 	global fov_map, color_dark_wall, color_light_wall
 	global color_light_ground, color_dark_ground
-	global fov_recompute
+	global fov_recompute, panel_signature
 
 	if fov_recompute:
 		# recomputer FOV is needed (the player moved or something)
 		fov_recompute = False
-		tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-		# go through all the tiles, and set their background color
-		for y in range(MAP_HEIGHT):
-			for x in range(MAP_WIDTH):
-				visible = tcod.map_is_in_fov(fov_map, x, y)
-				wall = map[x][y].block_sight
-				if not visible:
-					# if it's not visible right now, the player can only see it if its explored
-					if map[x][y].explored:
-						#it's out of players fov
-						if wall:
-							tcod.console_set_char_background(con, x, y, color_dark_wall, tcod.BKGND_SET)
-						else:
-							tcod.console_set_char_background(con, x, y, color_dark_ground, tcod.BKGND_SET)
-				else:
-					#it's visible
-					if wall:
-						tcod.console_set_char_background(con, x, y, color_light_wall, tcod.BKGND_SET)
-					else:
-						tcod.console_set_char_background(con, x, y, color_light_ground, tcod.BKGND_SET)
-					# since it's visible, explore it
-					map[x][y].explored = True
-
-	# draw all objects in the list, except the player.
-	# we want it to always appear over all other objects! so its drawn later
-	for object in objects:
-		if object != player:
-			object.draw()
-	player.draw()
-
-	# blit the contents of "con" to the root console and present it
-	tcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
-
+		with profiler.phase('fov'):
+			compute_fov()
+		if headless:
+			return
+		with profiler.phase('tiles'):
+			color_tiles()
+
+	if headless:
+		return
+
+	# redraw the objects on the cells that changed, then put only those on the screen.
+	# if the camera moved, everything on the screen did
+	with profiler.phase('objects'):
+		draw_dirty_cells()
+	with profiler.phase('blit'):
+		if move_camera():
+			tcod.console_blit(con, camera_x, camera_y, SCREEN_WIDTH, PANEL_Y, root, 0, 0)
+		else:
+			for (y, x1, x2) in dirty.spans(camera_x, camera_y, SCREEN_WIDTH, PANEL_Y):
+				tcod.console_blit(con, x1, y, x2 - x1 + 1, 1, root, x1 - camera_x, y - camera_y)
+		dirty.clear()
+
+	# the panel only shows the messages, the player's HP and the dungeon level, so skip it if none of them changed.
+	# the timings change all the time though, so with the overlay on it's always redrawn
+	signature = (game_msgs.revision, player.fighter.hp, player.fighter.max_hp, dungeon_level, show_profile)
+	if signature == panel_signature and not show_profile:
+		return
+	panel_signature = signature
+	with profiler.phase('panel'):
+		render_panel()
+
+def render_panel():
 	# prepare to render the GUI panel
 	tcod.console_set_default_background(panel, tcod.black)
 	tcod.console_clear(panel)
 	
-	#print the game messages, one line at a time
-	y = 1
-	for (line, color) in game_msgs:
-		tcod.console_set_default_foreground(panel, color)
-		tcod.console_print_ex(panel, MSG_X, y, tcod.BKGND_NONE, tcod.LEFT, line)
-		y += 1
+	if show_profile:
+		render_profile()
+	else:
+		#print the game messages, one line at a time
+		y = 1
+		for (line, color) in game_msgs.lines(MSG_WIDTH, MSG_HEIGHT):
+			tcod.console_set_default_foreground(panel, color)
+			tcod.console_print_ex(panel, MSG_X, y, tcod.BKGND_NONE, tcod.LEFT, line)
+			y += 1
 	# show the player's stats
 	render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, tcod.light_red, tcod.darker_red)
+	tcod.console_set_default_foreground(panel, tcod.light_gray)
+	if world is None:
+		tcod.console_print_ex(panel, 1, 3, tcod.BKGND_NONE, tcod.LEFT, 'Dungeon level ' + str(dungeon_level))
+	else:
+		tcod.console_print_ex(panel, 1, 3, tcod.BKGND_NONE, tcod.LEFT, 'Overworld')
 
 	# blit the contents of "panel" to the root console
-	tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
-
+	tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, root, 0, PANEL_Y)
+
+def render_profile():
+	# the median and 95th percentile time of each phase, in two columns where the messages usually are
+	tcod.console_set_default_foreground(panel, tcod.light_gray)
+	tcod.console_print_ex(panel, MSG_X, 0, tcod.BKGND_NONE, tcod.LEFT, '%-15s %5s/%5s' % ('phase (ms)', 'p50', 'p95'))
+	column_width = MSG_WIDTH // 2
+	for (i, name) in enumerate(sorted(profiler.samples)[:2 * MSG_HEIGHT - 2]):
+		(p50, p95) = profiler.percentiles(name, (50, 95)) * 1000
+		(column, row) = divmod(i, MSG_HEIGHT - 1)
+		line = '%-15s %5.2f/%5.2f' % (name[:15], p50, p95)
+		tcod.console_print_ex(panel, MSG_X + column * column_width, row + 1, tcod.BKGND_NONE, tcod.LEFT, line)
+
+
+def move_camera():
+	# keep the player in the middle of the screen, as far as the map allows. the camera is the map
+	# position shown in the top left corner of the screen. returns whether it moved
+	global camera_x, camera_y
+	x = min(max(player.x - SCREEN_WIDTH // 2, 0), max(map.width - SCREEN_WIDTH, 0))
+	y = min(max(player.y - PANEL_Y // 2, 0), max(map.height - PANEL_Y, 0))
+	if (x, y) == (camera_x, camera_y):
+		return False
+	(camera_x, camera_y) = (x, y)
+	return True
+
+def compute_fov():
+	# work out what the player can see from where they stand (unless it's in the cache from last time they
+	# stood there), and remember it as explored. the objects in view are kept until the next time, and the
+	# actors among them wake up
+	global visible
+	fov = fov_map.fov
+	key = (player.x, player.y, TORCH_RADIUS, FOV_ALGO, FOV_LIGHT_WALLS, map.revision)
+	if not fov_cache.load(key, fov):
+		tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+		fov_cache.store(key, fov)
+	(x1, y1, x2, y2) = fov_cache.window(player.x, player.y)
+	map.explored[x1:x2, y1:y2] |= fov[x1:x2, y1:y2]
+	nearby = object_index.near(player.x, player.y, TORCH_RADIUS or max(map.width, map.height))
+	visible = VisibleObjects(object for object in nearby if object is not player and fov[object.x, object.y])
+	for object in visible:
+		if object.ai:
+			scheduler.wake(object)
+
+def color_tiles():
+	# color the tiles at once: visible tiles are lit, explored ones are dark, the rest are left alone.
+	# a tile can only go in or out of view (or be explored) inside the square the FOV can reach, so only the
+	# squares of the last time and this time are looked at. the whole map is colored the first time after
+	# the consoles are made, or if its tiles changed since
+	window = fov_cache.window(player.x, player.y)
+	(x1, y1, x2, y2) = window
+	if dirty.colored is None or dirty.colored[4] != map.revision:
+		(x1, y1, x2, y2) = (0, 0, map.width, map.height)
+	else:
+		(x1, y1) = (min(x1, dirty.colored[0]), min(y1, dirty.colored[1]))
+		(x2, y2) = (max(x2, dirty.colored[2]), max(y2, dirty.colored[3]))
+	dirty.colored = window + (map.revision,)
+
+	visible = fov_map.fov[x1:x2, y1:y2]
+	wall = map.block_sight[x1:x2, y1:y2].view(np.uint8)
+	bg = con.bg[x1:x2, y1:y2]
+	new_bg = np.select(
+		(visible[..., np.newaxis], map.explored[x1:x2, y1:y2, np.newaxis]),
+		(light_colors[wall], dark_colors[wall]),
+		bg)
+	# only the tiles whose color changed (which includes every tile that went in or out of view) need redrawing
+	dirty.mark_mask((new_bg != bg).any(axis=2), x1, y1)
+	bg[:] = new_bg
+
+def draw_dirty_cells():
+	# erase the characters on the dirty cells, then draw the topmost visible object (or else the decoration)
+	# on each of them. a tile with both may come up twice, which draws the same thing again. only the box
+	# around the dirty cells is looked at
+	if dirty.box is None:
+		return
+	(x1, y1, x2, y2) = dirty.box
+	cells = dirty.cells[x1:x2, y1:y2]
+	con.ch[x1:x2, y1:y2][cells] = ord(' ')
+	if np.count_nonzero(cells) < len(object_index.tiles) + len(decorations.tiles):
+		occupied = ((int(x) + x1, int(y) + y1) for (x, y) in np.argwhere(cells))
+	else:
+		occupied = (pos for tiles in (object_index.tiles, decorations.tiles) for pos in tiles if dirty.cells[pos])
+	for (x, y) in occupied:
+		if not fov_map.fov[x, y]:
+			continue
+		stack = object_index.at(x, y)
+		if stack:
+			# the player always appears over all other objects, otherwise the last one in drawing order does
+			object = player if player in stack else stack[-1]
+			con.ch[x, y] = entities.char[object.id]
+			con.fg[x, y] = entities.color[object.id]
+		elif (x, y) in decorations.tiles:
+			decoration = decorations.tiles[(x, y)]
+			con.ch[x, y] = ord(decoration.char)
+			con.fg[x, y] = decoration.color
+
+def restore_screen(x, y, width, height):
+	# put back the part of the screen a menu covered. the map and panel consoles still hold what was there,
+	# so it's copied from them instead of drawing the whole screen again
+	bottom = min(y + height, SCREEN_HEIGHT)
+	if y < PANEL_Y and camera_x is not None:
+		tcod.console_blit(con, camera_x + x, camera_y + y, width, min(bottom, PANEL_Y) - y, root, x, y)
+	if bottom > PANEL_Y:
+		top = max(y, PANEL_Y)
+		tcod.console_blit(panel, x, top - PANEL_Y, width, bottom - top, root, x, top)
 
 def handle_keys():
 	# key = tcod.console_check_for_keypress() # Real time
-	key = tcod.console_wait_for_keypress(True)
+	key = input_source.wait_for_key()
 	if key.vk == tcod.KEY_ENTER and key.lalt:
 		#Alt+Enter fullscreen
-		tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
+		if not headless and terminal is None:
+			tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
 	elif key.vk == tcod.KEY_ESCAPE:
 		return 'exit' #exit game
-	global player_x, player_y
+	global player_x, player_y, show_profile
 	
 	if game_state == 'playing':
 		# movement keys
-		if tcod.console_is_key_pressed(tcod.KEY_UP):
+		if key.vk == tcod.KEY_UP:
 			player_move_or_attack(0, -1)
 			fov_recompute = True
-		elif tcod.console_is_key_pressed(tcod.KEY_DOWN):
+		elif key.vk == tcod.KEY_DOWN:
 			player_move_or_attack(0, 1)
 			fov_recompute = True
-		elif tcod.console_is_key_pressed(tcod.KEY_LEFT):
+		elif key.vk == tcod.KEY_LEFT:
 			player_move_or_attack(-1, 0)
 			fov_recompute = True
-		elif tcod.console_is_key_pressed(tcod.KEY_RIGHT):
+		elif key.vk == tcod.KEY_RIGHT:
 			player_move_or_attack(1, 0)
 			fov_recompute = True
 		#test for other keys
@@ -406,56 +1690,69 @@ def handle_keys():
 
 		if key_char == 'g':
 			#pick up an item
-			for object in objects:   #look for an item in the player's tile
-				if object.x == player.x and object.y == player.y and object.item:
-					object.item.pick_up()
-					break
+			object = object_index.item_at(player.x, player.y)   #look for an item in the player's tile
+			if object is not None:
+				object.item.pick_up()
 		elif key_char == 'i':
 			#show the inventory; if an item is selected, use it
 			chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
 			if chosen_item is not None:
 				chosen_item.use()
+		elif key_char == 'm':
+			#look back through the messages
+			message_history()
+			return 'didnt-take-turn'
+		elif key_char == 'p':
+			#show or hide how long each part of a turn takes
+			show_profile = not show_profile
+			return 'didnt-take-turn'
+		elif key_char == '>':
+			#go down stairs, if the player is on them
+			if stairs is not None and stairs.x == player.x and stairs.y == player.y:
+				next_level()
+				return 'didnt-take-turn'   #the monsters down there haven't noticed you yet
 	else:
 
 		return 'didnt-take-turn'
 
 def place_objects(room):
 	#choose random number of monsters
-	num_monsters = tcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+	num_monsters = tcod.random_get_int(spawn_rng, 0, MAX_ROOM_MONSTERS)
 
 	for i in range(num_monsters):
 		# choose random spot for this monster
-		x = tcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+		x = tcod.random_get_int(spawn_rng, room.x1+1, room.x2-1)
+		y = tcod.random_get_int(spawn_rng, room.y1+1, room.y2-1)
 
 		if not is_blocked(x, y):
-			if tcod.random_get_int(0, 0, 100) < 80:  # 80% chance of orc
+			if tcod.random_get_int(spawn_rng, 0, 100) < 80:  # 80% chance of orc
 				#create an orc
-				fighter_component = Fighter(hp=10, defense=0, power=3, death_function=monster_death)
+				fighter_component = Fighter(hp=ORC_HP, defense=ORC_DEFENSE, power=ORC_POWER, death_function=monster_death)
 				ai_component = BasicMonster()
 
 				monster = Object(x, y, 'o', 'orc', tcod.desaturated_green,
 					blocks=True,fighter=fighter_component, ai=ai_component)
 			else:
 				# create a troll
-				fighter_component = Fighter(hp=16, defense=1, power=4)
+				fighter_component = Fighter(hp=TROLL_HP, defense=TROLL_DEFENSE, power=TROLL_POWER,
+					death_function=monster_death)
 				ai_component = BasicMonster()
 
 				monster = Object(x, y, 'T', 'troll', tcod.darker_green,
 					blocks=True,fighter=fighter_component, ai=ai_component)
 
-			objects.append(monster)
+			add_object(monster)
 
-	num_items = tcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
+	num_items = tcod.random_get_int(spawn_rng, 0, MAX_ROOM_ITEMS)
 
 	for i in range(num_items):
 		#choose random spot for this item
-		x = tcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+		x = tcod.random_get_int(spawn_rng, room.x1+1, room.x2-1)
+		y = tcod.random_get_int(spawn_rng, room.y1+1, room.y2-1)
 
 		#only place it if the thile is not blocked
 		if not is_blocked(x, y):
-			dice = tcod.random_get_int(0,0,100)
+			dice = tcod.random_get_int(spawn_rng, 0,100)
 			if dice < 70:
 				#create a healing potion (70% chance)
 				item_component = Item(use_function=cast_heal)
@@ -470,21 +1767,30 @@ def place_objects(room):
 
 				item = Object(x, y, '#', 'scroll of confusion', tcod.light_yellow, item=item_component)
 
-			objects.append(item)
-			item.send_to_back()  #items appear below other objects
+			add_object(item)
 
 
 def is_blocked(x, y):
 	#first test the map tile
-	if map[x][y].blocked:
+	if map.blocked[x, y]:
 		return True
 
 	# now check for any blocking objects
-	for object in objects:
-		if object.blocks and object.x == x and object.y == y:
-			return True
-
-	return False
+	return object_index.blocker_at(x, y) is not None
+
+def add_object(obj):
+	# put a new object on the map
+	objects.append(obj)
+	object_index.add(obj)
+	if obj.ai:
+		schedule_actor(obj)
+
+def remove_object(obj):
+	# take an object off the map
+	objects.remove(obj)
+	object_index.remove(obj)
+	visible.discard(obj)
+	scheduler.sleep(obj)
 
 def player_move_or_attack(dx, dy):
 	global fov_recompute
@@ -494,11 +1800,7 @@ def player_move_or_attack(dx, dy):
 	y = player.y + dy
 
 	# try to find an attackable object there
-	target = None
-	for object in objects:
-		if object.fighter and object.x == x and object.y == y:
-			target = object
-			break
+	target = object_index.fighter_at(x, y)
 	
 	# attack if target found, move otherwise
 	if target is not None:
@@ -507,6 +1809,103 @@ def player_move_or_attack(dx, dy):
 		player.move(dx,dy)
 		fov_recompute = True
 
+def take_monster_turns():
+	# the player just acted, so everything that's due before their next action happens, in time order.
+	# only the actors that are awake are looked at. the profiler gets how long each kind of AI took altogether
+	turns_start = time.perf_counter()
+	turn_times = collections.defaultdict(float)
+	while True:
+		due = scheduler.pop_due()
+		if due is None:
+			break
+		(turn_time, actors, events) = due
+		for event in events:
+			event()
+
+		plans = {}
+		if BATCH_AI:
+			# basic monsters decide all at once; this gives the same result as asking them one by one, since
+			# what they decide only depends on their own position, the player's and the FOV, none of which
+			# the other monsters change. whether a step is still free is checked when it's their turn.
+			with profiler.phase('ai plan'):
+				basic = np.array([actor.id for actor in actors if type(actor.ai) is BasicMonster], dtype=np.intp)
+				plans = dict(zip(basic.tolist(), plan_basic_monster_turns(basic)))
+
+		for object in actors:
+			if not object.ai:   #died before its turn came
+				continue
+			kind = type(object.ai).__name__   #before the turn, a confused monster may come to its senses during it
+			start = time.perf_counter()
+			if object.id in plans:
+				carry_out_plan(object, plans[object.id])
+			else:
+				object.ai.take_turn()
+			turn_times[kind] += time.perf_counter() - start
+			# actors with nothing to do sleep until something wakes them up, the others wait for their next turn
+			if object.ai and not object.ai.dormant():
+				scheduler.wake(object, turn_time + TURN_TIME * NORMAL_SPEED // object.speed)
+	scheduler.now += TURN_TIME
+	for (kind, seconds) in turn_times.items():
+		profiler.record(kind, turns_start, seconds)
+
+def carry_out_plan(object, plan):
+	# do what plan_basic_monster_turns decided for a monster, if it still can
+	if plan == 'attack':
+		if player.fighter.hp > 0:   #the player may have died earlier this turn
+			object.fighter.attack(player)
+	elif plan is not None:
+		(x, y) = plan
+		if object_index.blocker_at(x, y) is not None:
+			object.move_astar(player)   #another monster is in the way, try to get around it
+		else:
+			object_index.move(object, x, y)
+
+def plan_basic_monster_turns(ids):
+	# what each of the basic monsters with the given entity ids wants to do this turn, as a list with one
+	# entry per monster: None to stay put, 'attack' to attack the player, or the (x, y) tile to step onto
+	if not len(ids):
+		return []
+	xs = entities.x[ids].astype(np.intp)
+	ys = entities.y[ids].astype(np.intp)
+
+	# if you can see it, it can see you
+	in_view = fov_map.fov[xs, ys]
+	dx = player.x - xs
+	dy = player.y - ys
+	distance = np.sqrt(dx ** 2 + dy ** 2)
+	far = distance >= 2
+
+	# the monsters that see the player and aren't next to them step closer, the same steps step_towards_player
+	# picks: the greedy step straight at the player, unless a neighbour is closer to them along the walkable
+	# tiles. the distance field is only needed if there are any
+	plans = [None] * len(ids)
+	chasing = np.flatnonzero(in_view & far)
+	if len(chasing):
+		(xs, ys) = (xs[chasing], ys[chasing])
+		with np.errstate(divide='ignore', invalid='ignore'):
+			step_x = xs + np.round(dx[chasing] / distance[chasing]).astype(np.intp)
+			step_y = ys + np.round(dy[chasing] / distance[chasing]).astype(np.intp)
+		field = player_field.get()
+		here = field.at(xs, ys)
+		best = field.at(step_x, step_y)
+		best_x = step_x.copy()
+		best_y = step_y.copy()
+		for (ox, oy) in DIRECTIONS:
+			around = field.at(xs + ox, ys + oy)
+			closer = around < best
+			best[closer] = around[closer]
+			best_x[closer] = xs[closer] + ox
+			best_y[closer] = ys[closer] + oy
+		found = best < here
+		step_x = np.where(found, best_x, step_x)
+		step_y = np.where(found, best_y, step_y)
+		# steps into walls fail no matter what the other monsters do, so they can be dropped right away
+		for i in np.flatnonzero(~map.blocked[step_x, step_y]):
+			plans[chasing[i]] = (int(step_x[i]), int(step_y[i]))
+	for i in np.flatnonzero(in_view & ~far):
+		plans[i] = 'attack'
+	return plans
+
 def player_death(player):
 	#the game ended!
 	global game_state
@@ -516,17 +1915,19 @@ def player_death(player):
 	#for added effect, transform player into a corpse!
 	player.char = '%'
 	player.color = tcod.dark_red
+	dirty.mark(player.x, player.y)
 
 def monster_death(monster):
-	#transform it into a nasty corpse! it doesn't block, can't be attacked and doesn't move
+	#transform it into a nasty corpse! it doesn't block, can't be attacked and doesn't move, so it stops being
+	#an object and only stays on the floor as a decoration
 	message(monster.name.capitalize() + ' is dead!')
-	monster.char = '%'
-	monster.color = tcod.dark_red
-	monster.blocks = False
+	game_stats['kills'] += 1
+	decorations.add(monster.x, monster.y, '%', tcod.dark_red, 'remains of ' + monster.name)
+	remove_object(monster)
+	#no fighter or AI left, so a turn or an event still pending for it knows it's gone
 	monster.fighter = None
 	monster.ai = None
-	monster.name = 'remains of ' + monster.name
-	monster.send_to_back()
+	monster.destroy()
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 	#render a bar (HP, experience, etc.) first calculate the width of the bar
@@ -546,50 +1947,123 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 	tcod.console_print_ex(panel, int(x + total_width / 2), y, tcod.BKGND_NONE, tcod.CENTER, name + ': ' + str(value) + '/' + str(maximum))
 
 def message(new_msg, color = tcod.white):
-	#split the message if necessary, among multiple lines
-	new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+	#add the message to the log; it's split into lines when it's shown
+	game_msgs.add(new_msg, color)
+
+def message_history():
+	#show the message log full screen, and let the player scroll through it until they press another key
+	global history_window
+	height = SCREEN_HEIGHT - 2
+	offset = 0
+	if not headless and history_window is None:
+		history_window = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+	try:
+		while True:
+			lines = game_msgs.lines(SCREEN_WIDTH, height, offset)
+			if not headless:
+				tcod.console_clear(history_window)
+				tcod.console_set_default_foreground(history_window, tcod.white)
+				tcod.console_print_ex(history_window, 0, 0, tcod.BKGND_NONE, tcod.LEFT,
+					'Message log: UP/DOWN and PAGEUP/PAGEDOWN to scroll, any other key to close')
+				y = 2
+				for (line, color) in lines:
+					tcod.console_set_default_foreground(history_window, color)
+					tcod.console_print_ex(history_window, 0, y, tcod.BKGND_NONE, tcod.LEFT, line)
+					y += 1
+				tcod.console_blit(history_window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, root, 0, 0)
+				present()
+
+			key = input_source.wait_for_key()
+			#scrolling up is only possible while there's a full page of older lines
+			if key.vk == tcod.KEY_UP and len(lines) == height:
+				offset += 1
+			elif key.vk == tcod.KEY_PAGEUP and len(lines) == height:
+				offset += height
+			elif key.vk == tcod.KEY_DOWN:
+				offset = max(offset - 1, 0)
+			elif key.vk == tcod.KEY_PAGEDOWN:
+				offset = max(offset - height, 0)
+			else:
+				break
+	finally:
+		#the log was drawn over everything. it's put back even if the key isn't there yet, so a turn
+		#that's played again starts from the same screen
+		if not headless:
+			restore_screen(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+class MenuCache:
+	# the menus shown lately, each already drawn on its own off-screen console, so opening one again is
+	# only a blit. a menu is known by its header, options and width; when there are more than size of them
+	# the least recently shown is dropped, and its console is drawn over for the next menu of its size
+	def __init__(self, size=MENU_CACHE_SIZE):
+		self.size = size
+		self.windows = collections.OrderedDict()   #(header, options, width) -> console
+
+	def get(self, header, options, width):
+		key = (header, tuple(options), width)
+		window = self.windows.get(key)
+		if window is not None:
+			self.windows.move_to_end(key)
+			return window
+
+		#calculate total height for the header (after auto-wrap) and one line per option
+		header_height = tcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+		height = len(options) + header_height
+
+		#an off-screen console that represents the menu's window: the oldest one if it's the right size
+		window = None
+		if len(self.windows) >= self.size:
+			(_, window) = self.windows.popitem(last=False)
+			if (window.width, window.height) != (width, height):
+				window = None
+		if window is None:
+			window = tcod.console_new(width, height)
+		else:
+			tcod.console_clear(window)
 
-	for line in new_msg_lines:
-		#if the buffer is full, remove the first line to make room for the new one
-		if len(game_msgs) == MSG_HEIGHT:
-			del game_msgs[0]
+		#print the header, with auto-wrap
+		tcod.console_set_default_foreground(window, tcod.white)
+		tcod.console_print_rect_ex(window, 0, 0, width, height, tcod.BKGND_NONE, tcod.LEFT, header)
+
+		#print all the options
+		y = header_height
+		letter_index = ord('a')
+		for option_text in options:
+			text = '(' + chr(letter_index) + ') ' + option_text
+			tcod.console_print_ex(window, 0, y, tcod.BKGND_NONE, tcod.LEFT, text)
+			y += 1
+			letter_index += 1
+
+		self.windows[key] = window
+		return window
+
+menus = MenuCache()
+history_window = None   #the console the message log is drawn on, made the first time it's shown
 
-		#add the new line as a tuple, with text and the color
-		game_msgs.append( (line, color) )
-	
 def menu(header, options, width):
 	if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
 
-	#calculate total height for the header (after auto-wrap) and one line per option
-	header_height = tcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
-	height = len(options) + header_height
-
-	#create an off-screen console that represents the menu's window
-	window = tcod.console_new(width, height)
-
-	#print the header, with auto-wrap
-	tcod.console_set_default_foreground(window, tcod.white)
-	tcod.console_print_rect_ex(window, 0, 0, width, height, tcod.BKGND_NONE, tcod.LEFT, header)
-
-	#print all the options
-	y = header_height
-	letter_index = ord('a')
-	for option_text in options:
-		text = '(' + chr(letter_index) + ') ' + option_text
-		tcod.console_print_ex(window, 0, y, tcod.BKGND_NONE, tcod.LEFT, text)
-		y += 1
-		letter_index += 1
-
-	#blit the contents of "window" to the root console
-	x = SCREEN_WIDTH/2 - width/2
-	y = SCREEN_HEIGHT/2 - height/2
-	#tcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
-	#tcod.console_blit(window, 0, 0, width, height, x, y, 1.0, 0.7)
-	tcod.console_blit(window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+	if headless:
+		#nothing to show, just wait for the key that picks an option
+		return menu_choice(input_source.wait_for_key(), options)
+
+	window = menus.get(header, options, width)
+
+	#blit only the menu's window to the middle of the root console, with the map showing dimly through it
+	height = window.height
+	x = SCREEN_WIDTH // 2 - width // 2
+	y = SCREEN_HEIGHT // 2 - height // 2
+	tcod.console_blit(window, 0, 0, width, height, root, x, y, 1.0, 0.7)
 
 	#present the root console to the player and wait for a key-press
-	tcod.console_flush()
-	key = tcod.console_wait_for_keypress(True)
+	present()
+	try:
+		key = input_source.wait_for_key()
+	finally:
+		restore_screen(x, y, width, height)   #put back what the menu covered, even if the key isn't there yet
+	return menu_choice(key, options)
+
+def menu_choice(key, options):
 	#convert the ASCII code to and index; if it corresponds to an option, return it
 	index = key.c - ord('a')
 	if index >= 0 and index < len(options): return index
@@ -632,80 +2106,853 @@ def cast_confuse():
 		message('No enemy is close enough to confuse.', tcod.red)
 		return 'cancelled'
 
-	#replace the monster's AI with a "confused" one; after some turns it will restore the old AI
-	old_ai = monster.ai
-	monster.ai = ConfusedMonster(old_ai)
-	monster.ai.owner = monster   #tell the new component who owns it
+	#replace the monster's AI with a "confused" one; after some turns it will restore the old AI.
+	#a monster that's confused already stays confused that much longer, and still goes back to its own AI
+	if type(monster.ai) is ConfusedMonster:
+		monster.ai.until += CONFUSE_NUM_TURNS * TURN_TIME
+	else:
+		old_ai = monster.ai
+		monster.ai = ConfusedMonster(old_ai)
+		monster.ai.owner = monster   #tell the new component who owns it
+	schedule_actor(monster)
 	message('The eyes of the ' + monster.name + ' look vacant, as he starts to stumble around!', tcod.light_green)
 
 def closest_monster(max_range):
-	#find the closest enemy, up to a maximum range, and in the player's FOV
-	closest_enemy = None
-	closest_dist = max_range + 1   #start with a (slightly more than) maximum range
-	
-	for object in objects:
-		if object.fighter and not object == player and tcod.map_is_in_fov(fov_map, object.x, object.y):
-			#calculate distance between this object and the player
-			dist = player.distance_to(object)
-			if dist < closest_dist:   #it's closer, so remember it
-				closest_enemy = object
-				closest_dist = dist
-	return closest_enemy
+	#find the closest enemy, up to a maximum range, and in the player's FOV.
+	#the objects in view are already sorted by distance, so it's the first one that can fight
+	for object in visible.within(max_range):
+		if object.fighter:
+			return object
+	return None
 game_state = 'playing'
 player_action = None
 
 #########################################
-# Initialization & Main Loop
+# Saving & Loading
+#########################################
+
+# a save file starts with this header: magic, version, (unused) flags, the map's width and height, then
+# the offset and length of each section. the sections are the tile planes (blocked, block_sight and explored,
+# one byte per tile in [x, y] order, so they can be memory-mapped), the entity records, the random number
+# generators, and a small JSON block with everything else.
+SAVE_MAGIC = b'PYRG'
+SAVE_VERSION = 2
+SAVE_HEADER = struct.Struct('<4sHHII8Q')
+SAVE_ALIGN = 64
+
+# one packed record per entity, on the map or in the inventory
+ENTITY_DTYPE = np.dtype([
+	('x', '<i4'), ('y', '<i4'),
+	('char', '<u4'), ('color', 'u1', 3),
+	('name', '<u4'),   #index into the names list in the JSON block
+	('flags', 'u1'),
+	('hp', '<i4'), ('max_hp', '<i4'), ('defense', '<i4'), ('power', '<i4'),
+	('death', 'u1'), ('ai', 'u1'), ('old_ai', 'u1'), ('ai_turns', '<i4'), ('item', 'u1'),
+	('speed', '<u2'),
+])
+ENTITY_BLOCKS = 1
+ENTITY_PLAYER = 2
+ENTITY_IN_INVENTORY = 4
+ENTITY_FIGHTER = 8
+ENTITY_ITEM = 16
+ENTITY_STAIRS = 32
+ENTITY_DECORATION = 64   #only a look and a name, for the Decorations
+
+# functions and classes are saved as their position in these lists
+DEATH_FUNCTIONS = [None, player_death, monster_death]
+USE_FUNCTIONS = [None, cast_heal, cast_lightning, cast_confuse]
+
+# the state of a Mersenne Twister: its 624 numbers, then the position in them
+RNG_WORDS = 625
+
+def pack_entities(objects, inventory, floor=()):
+	# turn the objects, the inventory and the decorations on the floor (as (x, y, decoration)) into records,
+	# plus the list of names they refer to. the plain data is copied straight out of the entity store's arrays
+	saved = objects + inventory
+	ids = np.fromiter((obj.id for obj in saved), dtype=np.intp, count=len(saved))
+	fighters = np.fromiter((obj.fighter is not None for obj in saved), dtype=bool, count=len(saved))
+	records = np.zeros(len(saved), dtype=ENTITY_DTYPE)
+	for field in ['x', 'y', 'char', 'color']:
+		records[field] = getattr(entities, field)[ids]
+	for field in ['hp', 'max_hp', 'defense', 'power']:
+		records[field][fighters] = getattr(entities, field)[ids[fighters]]
+	records['ai'] = entities.ai_kind[ids]
+	records['speed'] = entities.speed[ids]
+	names = []
+	name_index = {}
+	for (i, obj) in enumerate(saved):
+		record = records[i]
+		if obj.name not in name_index:
+			name_index[obj.name] = len(names)
+			names.append(obj.name)
+		record['name'] = name_index[obj.name]
+		flags = 0
+		if obj.blocks: flags |= ENTITY_BLOCKS
+		if obj is player: flags |= ENTITY_PLAYER
+		if i >= len(objects): flags |= ENTITY_IN_INVENTORY
+		if obj is stairs: flags |= ENTITY_STAIRS
+		if obj.fighter:
+			flags |= ENTITY_FIGHTER
+			record['death'] = DEATH_FUNCTIONS.index(obj.fighter.death_function)
+		if type(obj.ai) is ConfusedMonster:
+			# confusions don't nest (cast_confuse makes one last longer instead), so there's one AI to go back to
+			record['old_ai'] = AI_CLASSES.index(type(obj.ai.old_ai))
+			record['ai_turns'] = obj.ai.turns_left()
+		if obj.item:
+			flags |= ENTITY_ITEM
+			record['item'] = USE_FUNCTIONS.index(obj.item.use_function)
+		record['flags'] = flags
+
+	floor = list(floor)
+	floor_records = np.zeros(len(floor), dtype=ENTITY_DTYPE)
+	for (record, (x, y, decoration)) in zip(floor_records, floor):
+		if decoration.name not in name_index:
+			name_index[decoration.name] = len(names)
+			names.append(decoration.name)
+		(record['x'], record['y']) = (x, y)
+		record['char'] = ord(decoration.char)
+		record['color'] = decoration.color
+		record['name'] = name_index[decoration.name]
+		record['flags'] = ENTITY_DECORATION
+	return np.concatenate([records, floor_records]), names
+
+def unpack_entities(records, names):
+	# rebuild the objects from their records. returns the objects on the map, the inventory, the player,
+	# the stairs, and the decorations on the floor (as (x, y, decoration))
+	objects = []
+	inventory = []
+	player = None
+	stairs = None
+	floor = []
+	for record in records:
+		flags = int(record['flags'])
+		if flags & ENTITY_DECORATION:
+			floor.append((int(record['x']), int(record['y']),
+				Decoration(chr(record['char']), tuple(int(c) for c in record['color']), names[record['name']])))
+			continue
+		fighter = None
+		if flags & ENTITY_FIGHTER:
+			fighter = Fighter(hp=int(record['max_hp']), defense=int(record['defense']), power=int(record['power']),
+				death_function=DEATH_FUNCTIONS[record['death']])
+		ai = None
+		if record['ai']:
+			if AI_CLASSES[record['ai']] is ConfusedMonster:
+				ai = ConfusedMonster(AI_CLASSES[record['old_ai']](), num_turns=int(record['ai_turns']))
+			else:
+				ai = AI_CLASSES[record['ai']]()
+		item = None
+		if flags & ENTITY_ITEM:
+			item = Item(use_function=USE_FUNCTIONS[record['item']])
+		obj = Object(int(record['x']), int(record['y']), chr(record['char']), names[record['name']],
+			tcod.Color(*(int(c) for c in record['color'])), blocks=bool(flags & ENTITY_BLOCKS),
+			fighter=fighter, ai=ai, item=item, speed=int(record['speed']))
+		if fighter:
+			fighter.hp = int(record['hp'])
+		if type(ai) is ConfusedMonster:
+			ai.old_ai.owner = obj   #the AI it goes back to needs to know who it belongs to as well
+		if flags & ENTITY_PLAYER:
+			player = obj
+		if flags & ENTITY_STAIRS:
+			stairs = obj
+		if flags & ENTITY_IN_INVENTORY:
+			inventory.append(obj)
+		else:
+			objects.append(obj)
+	return objects, inventory, player, stairs, floor
+
+def pack_rng(rng):
+	state = rng.__getstate__()['random_c']['mt_cmwc']
+	return np.array(state['mt'] + [state['cur_mt']], dtype='<u4')
+
+def unpack_rng(words):
+	rng = tcod.random.Random.__new__(tcod.random.Random)
+	rng.__setstate__({'random_c': {'mt_cmwc': {
+		'algorithm': tcod.random.MERSENNE_TWISTER, 'distribution': tcod.DISTRIBUTION_LINEAR,
+		'mt': [int(w) for w in words[:624]], 'cur_mt': int(words[624]), 'Q': [0] * 4096, 'c': 0, 'cur': 0}}})
+	return rng
+
+def align(offset):
+	return (offset + SAVE_ALIGN - 1) // SAVE_ALIGN * SAVE_ALIGN
+
+def dump_game():
+	# the whole game state as bytes, in the save file format
+	(records, names) = pack_entities(objects, inventory, decorations)
+	rngs = np.concatenate([pack_rng(map_rng), pack_rng(spawn_rng), pack_rng(ai_rng)])
+	meta = json.dumps({
+		'seed': game_seed,
+		'dungeon_level': dungeon_level,
+		'game_state': game_state,
+		'names': names,
+		'messages': [(entry.text, tuple(entry.color), entry.count) for entry in game_msgs.entries],
+		'stats': game_stats,
+	}).encode()
+	return pack_sections(map.width, map.height, (map.blocked, map.block_sight, map.explored),
+		records, rngs.tobytes(), meta)
+
+def pack_sections(width, height, planes, records, rngs, meta):
+	# put the header and the sections together, each one aligned
+	planes = b''.join(np.asfortranarray(plane).view(np.uint8).tobytes(order='F') for plane in planes)
+	sections = [planes, records.tobytes(), rngs, meta]
+	offsets = []
+	offset = align(SAVE_HEADER.size)
+	for section in sections:
+		offsets += [offset, len(section)]
+		offset = align(offset + len(section))
+
+	data = bytearray(offset)
+	SAVE_HEADER.pack_into(data, 0, SAVE_MAGIC, SAVE_VERSION, 0, width, height, *offsets)
+	for (section, start) in zip(sections, offsets[::2]):
+		data[start:start + len(section)] = section
+	return bytes(data)
+
+def save_game(path):
+	with open(path, 'wb') as f:
+		f.write(dump_game())
+
+def read_save_header(data):
+	(magic, version, flags, width, height, *offsets) = SAVE_HEADER.unpack_from(data, 0)
+	if magic != SAVE_MAGIC:
+		raise ValueError('Not a saved game')
+	if version != SAVE_VERSION:
+		raise ValueError('Unsupported save version: %d' % version)
+	return width, height, list(zip(offsets[::2], offsets[1::2]))
+
+def load_game(path):
+	# restore a saved game. the tile planes are memory-mapped copy-on-write, so they're read lazily and
+	# exploring the map doesn't touch the file
+	with open(path, 'rb') as f:
+		header = f.read(SAVE_HEADER.size)
+		(width, height, sections) = read_save_header(header)
+		rest = {}
+		for (name, (offset, length)) in zip(('records', 'rngs', 'meta'), sections[1:]):
+			f.seek(offset)
+			rest[name] = f.read(length)
+	(planes_offset, _) = sections[0]
+	planes = [np.memmap(path, dtype=bool, mode='c', offset=planes_offset + i * width * height,
+		shape=(width, height), order='F') for i in range(3)]
+	restore_game(width, height, planes, rest['records'], rest['rngs'], rest['meta'])
+
+def load_game_from_bytes(data):
+	restore_game(*unpack_sections(data))
+
+def unpack_sections(data):
+	# split bytes in the save format into the map's size, its (writable) tile planes, and the other sections
+	(width, height, sections) = read_save_header(data)
+	(planes_offset, _) = sections[0]
+	planes = [np.frombuffer(data, dtype=bool, count=width * height, offset=planes_offset + i * width * height)
+		.reshape((width, height), order='F').copy(order='F') for i in range(3)]
+	(records, rngs, meta) = (data[offset:offset + length] for (offset, length) in sections[1:])
+	return width, height, planes, records, rngs, meta
+
+def restore_game(width, height, planes, records, rngs, meta):
+	global world, entities, scheduler, map, player, stairs, objects, object_index, decorations, player_field, inventory
+	global fov_map, visible, fov_recompute
+	global game_state, player_action, game_msgs, game_stats, dungeon_level
+	global map_rng, spawn_rng, ai_rng, game_seed
+
+	meta = json.loads(meta)
+	world = None
+	map = Map(width, height, *planes)
+	init_consoles(width, height)
+
+	entities = EntityStore()
+	scheduler = Scheduler()
+	(loaded_objects, inventory, player, stairs, floor) = unpack_entities(np.frombuffer(records, dtype=ENTITY_DTYPE),
+		meta['names'])
+	objects = []
+	object_index = SpatialIndex()
+	decorations = Decorations()
+	visible = VisibleObjects()
+	for obj in loaded_objects:
+		add_object(obj)
+	for (x, y, decoration) in floor:
+		decorations.add(x, y, *decoration)
+	player_field = DistanceField()
+
+	words = np.frombuffer(rngs, dtype='<u4').reshape(3, RNG_WORDS)
+	(map_rng, spawn_rng, ai_rng) = (unpack_rng(w) for w in words)
+	game_seed = meta['seed']
+	dungeon_level = meta['dungeon_level']
+
+	fov_map = make_fov_map()
+	fov_recompute = True
+	game_state = meta['game_state']
+	player_action = None
+	game_msgs = MessageLog()
+	for (text, color, count) in meta['messages']:
+		game_msgs.add(text, tcod.Color(*color), count)
+	game_stats = collections.Counter(meta.get('stats', {}))
+
+#########################################
+# Dungeon Levels
 #########################################
 
-tcod.console_set_custom_font(font_path, font_flags)
-tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT,window_title, fullscreen)
-tcod.sys_set_fps(LIMIT_FPS)
-con = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+# the settings a level is built from, which a worker process has to be told about
+LEVEL_SETTINGS = ['MAP_WIDTH', 'MAP_HEIGHT', 'MAP_GENERATOR', 'MAX_ROOMS', 'ROOM_MIN_SIZE', 'ROOM_MAX_SIZE',
+	'MAX_ROOM_MONSTERS', 'MAX_ROOM_ITEMS', 'CAVE_WALL_CHANCE', 'CAVE_SMOOTHING_STEPS',
+	'ORC_HP', 'ORC_DEFENSE', 'ORC_POWER', 'TROLL_HP', 'TROLL_DEFENSE', 'TROLL_POWER', 'LEVEL_CACHE_DIR']
+
+# the module globals that make up one game, for running several games in one process by swapping them in
+# and out (see server.py)
+SESSION_GLOBALS = ['entities', 'scheduler', 'map', 'player', 'stairs', 'objects', 'object_index', 'decorations',
+	'player_field', 'inventory', 'fov_map', 'fov_cache', 'visible', 'fov_recompute', 'game_state', 'player_action',
+	'game_msgs', 'game_stats', 'dungeon_level', 'map_rng', 'spawn_rng', 'ai_rng', 'game_seed', 'world', 'prefetcher',
+	'con', 'panel', 'dirty', 'panel_signature', 'camera_x', 'camera_y', 'terminal', 'root', 'input_source',
+	'show_profile']
+
+def level_settings():
+	return {name: globals()[name] for name in LEVEL_SETTINGS}
+
+def level_cache_path(seed, level):
+	# the file a new game on the given level is cached in, named after everything that goes into building it
+	settings = level_settings()
+	del settings['LEVEL_CACHE_DIR']
+	key = json.dumps([SAVE_VERSION, seed, level, settings], sort_keys=True).encode()
+	return os.path.join(LEVEL_CACHE_DIR, 'level-%s.sav' % hashlib.sha1(key).hexdigest())
+
+def save_level_cache(path):
+	# write the game as it starts to the cache, all at once, so another process never reads half of it
+	os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+	with tempfile.NamedTemporaryFile(dir=LEVEL_CACHE_DIR, suffix='.tmp', delete=False) as f:
+		f.write(dump_game())
+	os.replace(f.name, path)
+
+def make_level(level):
+	# generate a new dungeon level around the player (who keeps their stats and inventory),
+	# replacing the map and everything on it
+	global objects, object_index, decorations, player_field, fov_map, visible, fov_recompute, dungeon_level
+	dungeon_level = level
+	seed_level_rngs(level)
+	init_consoles(MAP_WIDTH, MAP_HEIGHT)
+
+	# the list of objects, the index of where they are, what lies on the floor, and who gets to act when
+	destroy_level_objects()
+	objects = []
+	object_index = SpatialIndex()
+	decorations = Decorations()
+	visible = VisibleObjects()
+	scheduler.clear()
+	add_object(player)
+	# how far every tile is from the player, for the monsters chasing them
+	player_field = DistanceField()
+
+	#generate map (at this point it's not drawn to the screen)
+	make_map()
+
+	# create the FOV map, according to the generated map
+	fov_map = make_fov_map()
+	fov_recompute = True
+
+def destroy_level_objects():
+	# free the entities of everything on the map but the player, before the map is replaced
+	for obj in objects:
+		if obj is not player:
+			obj.destroy()
+
+def build_level(seed, level, settings):
+	# build a dungeon level from scratch and return it in the save file format, with the player record
+	# marking where the player starts. this runs in a worker process, with its own throwaway game
+	global headless
+	headless = True
+	globals().update(settings)
+	new_game(seed, level)
+	return dump_game()
+
+def enter_level(data):
+	# swap in a level made by build_level, keeping the current player and inventory
+	global map, stairs, objects, object_index, decorations, player_field, fov_map, visible, fov_recompute
+	global dungeon_level
+	(width, height, planes, records, _, meta) = unpack_sections(data)
+	meta = json.loads(meta)
+	records = np.frombuffer(records, dtype=ENTITY_DTYPE)
+
+	map = Map(width, height, *planes)
+	init_consoles(width, height)
+	dungeon_level = meta['dungeon_level']
+	seed_level_rngs(dungeon_level)
+
+	destroy_level_objects()
+	scheduler.clear()
+	# the level's own player record only marks where the real player starts. it's left out before anything
+	# is made from the records, so the objects get the same entity ids as when make_level builds the level
+	# here, and a replay picks the same targets
+	is_start = (records['flags'] & ENTITY_PLAYER) != 0
+	start = records[is_start][0]
+	(level_objects, _, _, stairs, floor) = unpack_entities(records[~is_start], meta['names'])
+	objects = []
+	object_index = SpatialIndex()
+	decorations = Decorations()
+	visible = VisibleObjects()
+	player.x = int(start['x'])
+	player.y = int(start['y'])
+	add_object(player)
+	for obj in level_objects:
+		add_object(obj)
+	for (x, y, decoration) in floor:
+		decorations.add(x, y, *decoration)
+	player_field = DistanceField()
+
+	fov_map = make_fov_map()
+	fov_recompute = True
+
+class LevelPending(Exception):
+	# the level the player is going down to is still being built, and the game can't wait for it here
+	def __init__(self, future):
+		super().__init__('level not built yet')
+		self.future = future
+
+class LevelPrefetcher:
+	# builds the next levels in worker processes while the player is still on the current one.
+	# at most max_queued levels are built or kept ahead, and levels that can't be used anymore
+	# (for an earlier level, or another game) are dropped. the worker processes can be shared with
+	# other games by passing in their executor. unless block is set, taking a level that isn't done
+	# yet raises LevelPending instead of waiting for it
+	def __init__(self, max_queued=PREFETCH_LEVELS, executor=None, block=True):
+		self.max_queued = max_queued
+		self.executor = executor
+		self.own_executor = executor is None
+		self.block = block
+		self.futures = {}   #(seed, level) -> future of the level's data
+
+	def request(self, level):
+		# start building the levels after the given one, up to the limit
+		self.cancel_stale()
+		if self.executor is None:
+			#spawn rather than fork, so the workers don't inherit the window
+			self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1,
+				mp_context=multiprocessing.get_context('spawn'))
+		for next_level in range(level + 1, level + 1 + self.max_queued):
+			key = (game_seed, next_level)
+			if key not in self.futures:
+				self.futures[key] = self.executor.submit(build_level, game_seed, next_level, level_settings())
+
+	def take(self, level):
+		# the given level's data, waiting for it if it's still being built; None if it was never requested
+		future = self.futures.get((game_seed, level))
+		if future is None or future.cancelled():
+			self.futures.pop((game_seed, level), None)
+			return None
+		if not self.block and not future.done():
+			raise LevelPending(future)
+		del self.futures[(game_seed, level)]
+		return future.result()
+
+	def cancel_stale(self):
+		for (seed, level) in list(self.futures):
+			if seed != game_seed or level <= dungeon_level:
+				#a level that's already being built can't be stopped, but its result is thrown away
+				self.futures.pop((seed, level)).cancel()
+
+	def shutdown(self):
+		if self.executor is not None and self.own_executor:
+			self.executor.shutdown(wait=False, cancel_futures=True)
+			self.executor = None
+		for future in self.futures.values():
+			future.cancel()
+		self.futures = {}
+
+def next_level():
+	# go down to the next dungeon level, using the prefetched one if it's there
+	data = prefetcher.take(dungeon_level + 1) if prefetcher else None
+	message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', tcod.red)
+	if data is not None:
+		enter_level(data)
+	else:
+		make_level(dungeon_level + 1)
+	if prefetcher:
+		prefetcher.request(dungeon_level)
 
-# create object representing player
-fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
-player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component)
+#########################################
+# The Overworld
+#########################################
 
-# the list of objects
-objects = [player]
+class World:
+	# an overworld without edges, split into CHUNK_SIZE square chunks that are generated the first time the
+	# player comes near them. the map the game is played on is a window of WORLD_WINDOW x WORLD_WINDOW chunks
+	# around the player, which moves along whenever they step into another chunk, so FOV, rendering and the
+	# monsters only ever deal with that much. chunks that leave the window are kept in the save format,
+	# in memory for a while and then on disk (least recently used first), so memory use stays the same no
+	# matter how far the player goes
+	def __init__(self, directory=None, cache_size=CHUNK_CACHE_SIZE):
+		if directory is None:
+			self.temporary = tempfile.TemporaryDirectory(prefix='pyrogue-world-')
+			directory = self.temporary.name
+		self.directory = directory
+		self.cache = collections.OrderedDict()
+		self.cache_size = cache_size
+		self.origin = (0, 0)   #the chunk in the window's top left corner
+
+	def chunk_path(self, cx, cy):
+		return os.path.join(self.directory, 'chunk_%d_%d.bin' % (cx, cy))
+
+	def get(self, cx, cy):
+		# a chunk's data: from memory if it's there, then from disk, or else newly generated
+		key = (cx, cy)
+		if key in self.cache:
+			self.cache.move_to_end(key)
+			return self.cache[key]
+		path = self.chunk_path(cx, cy)
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				return f.read()
+		return generate_chunk(cx, cy)
+
+	def put(self, cx, cy, data):
+		# keep a chunk's data, writing the least recently used chunks to disk when there are too many
+		self.cache[(cx, cy)] = data
+		self.cache.move_to_end((cx, cy))
+		while len(self.cache) > self.cache_size:
+			((ox, oy), old) = self.cache.popitem(last=False)
+			with open(self.chunk_path(ox, oy), 'wb') as f:
+				f.write(old)
+
+	def window_chunks(self):
+		# the chunks in the window, with their position in it (in tiles)
+		(ox, oy) = self.origin
+		for i in range(WORLD_WINDOW):
+			for j in range(WORLD_WINDOW):
+				yield ox + i, oy + j, i * CHUNK_SIZE, j * CHUNK_SIZE
+
+	def enter(self, cx, cy):
+		# make the window around the given chunk the map, with the player in the middle of that chunk
+		self.origin = (cx - WORLD_WINDOW // 2, cy - WORLD_WINDOW // 2)
+		self.load_window()
+		middle = WORLD_WINDOW // 2 * CHUNK_SIZE + CHUNK_SIZE // 2
+		player.place(middle, middle)
+
+	def follow(self):
+		# move the window along if the player left its middle chunk
+		(dx, dy) = (player.x // CHUNK_SIZE - WORLD_WINDOW // 2, player.y // CHUNK_SIZE - WORLD_WINDOW // 2)
+		if (dx, dy) == (0, 0):
+			return
+		self.store_window()
+		self.origin = (self.origin[0] + dx, self.origin[1] + dy)
+		player.x -= dx * CHUNK_SIZE   #the old index is thrown away, so it doesn't need to know
+		player.y -= dy * CHUNK_SIZE
+		self.load_window()
+
+	def store_window(self):
+		# put the map back into its chunks, along with everything standing on each of them
+		chunk_objects = collections.defaultdict(list)
+		for obj in objects:
+			if obj is not player:
+				chunk_objects[(obj.x // CHUNK_SIZE, obj.y // CHUNK_SIZE)].append(obj)
+		chunk_floor = collections.defaultdict(list)
+		for (x, y, decoration) in decorations:
+			chunk_floor[(x // CHUNK_SIZE, y // CHUNK_SIZE)].append((x % CHUNK_SIZE, y % CHUNK_SIZE, decoration))
+		for (cx, cy, x, y) in self.window_chunks():
+			inside = chunk_objects[(x // CHUNK_SIZE, y // CHUNK_SIZE)]
+			for obj in inside:
+				obj.x -= x
+				obj.y -= y
+			(records, names) = pack_entities(inside, [], chunk_floor[(x // CHUNK_SIZE, y // CHUNK_SIZE)])
+			planes = [plane[x:x + CHUNK_SIZE, y:y + CHUNK_SIZE] for plane in (map.blocked, map.block_sight, map.explored)]
+			self.put(cx, cy, pack_sections(CHUNK_SIZE, CHUNK_SIZE, planes, records, b'', json.dumps({'names': names}).encode()))
+		destroy_level_objects()
+
+	def load_window(self):
+		# build the map out of the chunks in the window
+		global map, objects, object_index, decorations, player_field, fov_map, visible, fov_recompute
+		size = WORLD_WINDOW * CHUNK_SIZE
+		init_consoles(size, size)
+		map = Map(size, size)
+		objects = []
+		object_index = SpatialIndex()
+		decorations = Decorations()
+		visible = VisibleObjects()
+		scheduler.clear()
+		add_object(player)
+		for (cx, cy, x, y) in self.window_chunks():
+			(_, _, planes, records, _, meta) = unpack_sections(self.get(cx, cy))
+			for (plane, chunk_plane) in zip((map.blocked, map.block_sight, map.explored), planes):
+				plane[x:x + CHUNK_SIZE, y:y + CHUNK_SIZE] = chunk_plane
+			(chunk_objects, _, _, _, floor) = unpack_entities(np.frombuffer(records, dtype=ENTITY_DTYPE),
+				json.loads(meta)['names'])
+			for obj in chunk_objects:
+				obj.x += x
+				obj.y += y
+				add_object(obj)
+			for (dx, dy, decoration) in floor:
+				decorations.add(x + dx, y + dy, *decoration)
+		player_field = DistanceField()
+		fov_map = make_fov_map()
+		fov_recompute = True
 
-#inventory
-inventory = []
-#generate map (at this point it's not drawn to the screen)
-make_map()
+def make_overworld():
+	# start out in a new overworld instead of the dungeon, in the middle of chunk (0, 0)
+	global world, stairs, dungeon_level
+	world = World()
+	stairs = None   #there's no way down from up here
+	dungeon_level = 0
+	seed_level_rngs(dungeon_level)
+	world.enter(0, 0)
+
+def generate_chunk(cx, cy):
+	# a new chunk, in the save format. it's laid out and populated from its own random streams, so it
+	# comes out the same whenever it's generated
+	global map, objects, object_index, scheduler, map_rng, spawn_rng
+	level = (map, objects, object_index, scheduler, map_rng, spawn_rng)
+	try:
+		map = Map(CHUNK_SIZE, CHUNK_SIZE)
+		objects = []
+		object_index = SpatialIndex()
+		scheduler = Scheduler()
+		map_rng = make_rng(game_seed, 'map:%d,%d' % (cx, cy))
+		spawn_rng = make_rng(game_seed, 'spawn:%d,%d' % (cx, cy))
+
+		#a crossroads through the middle, which lines up with the neighbouring chunks' ones, so the whole
+		#world is connected. the rooms hang off it
+		middle = CHUNK_SIZE // 2
+		create_h_tunnel(0, CHUNK_SIZE - 1, middle)
+		create_v_tunnel(0, CHUNK_SIZE - 1, middle)
+		rooms = generate_rooms(CHUNK_ROOMS)
+		if rooms:
+			connect_rooms(Rect(middle - 1, middle - 1, 2, 2), rooms[0])
+		for room in rooms:
+			place_objects(room)
+
+		(records, names) = pack_entities(objects, [])
+		destroy_level_objects()
+		return pack_sections(CHUNK_SIZE, CHUNK_SIZE, (map.blocked, map.block_sight, map.explored),
+			records, b'', json.dumps({'names': names}).encode())
+	finally:
+		(map, objects, object_index, scheduler, map_rng, spawn_rng) = level
 
-# create the FOV map, according to the generated map
-fov_map = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-for y in range(MAP_HEIGHT):
-	for x in range (MAP_WIDTH):
-		tcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+#########################################
+# Initialization & Main Loop
+#########################################
 
-fov_recompute = True
-game_state = 'playing'
-player_action = None
+def init_window():
+	# open the game window; not needed when running headless
+	tcod.console_set_custom_font(font_path, font_flags)
+	tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT,window_title, fullscreen)
+	tcod.sys_set_fps(LIMIT_FPS)
+
+def init_terminal(out):
+	# draw on a terminal instead of a window. the screen is an off-screen console, which is sent to the
+	# terminal each time it's presented
+	global terminal, root
+	root = tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT, order='C')
+	terminal = AnsiTerminal(out)
+	terminal.start()
+
+@contextlib.contextmanager
+def raw_terminal(fd):
+	# put the terminal in raw mode while the game runs, so keys come through as they're pressed
+	if not os.isatty(fd):
+		yield
+		return
+	import termios, tty   #only there on Unix
+	saved = termios.tcgetattr(fd)
+	tty.setraw(fd)
+	try:
+		yield
+	finally:
+		termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+
+def present():
+	# show the screen: flush the window, or send what changed to the terminal
+	if terminal is not None:
+		terminal.flush(root)
+	else:
+		tcod.console_flush()
+
+def init_consoles(map_width, map_height):
+	global con, panel, dirty, panel_signature, camera_x, camera_y
+	# the map console is indexed [x, y] like the map planes, so they can be copied into it directly.
+	# it's big enough for the whole map, even if only the part that fits on the screen is shown.
+	# both consoles are off-screen, so they work without a window too
+	con = tcod.console.Console(max(SCREEN_WIDTH, map_width), max(SCREEN_HEIGHT, map_height), order='F')
+	panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	# the cells of the map that have to be redrawn, and what the panel showed when it was last drawn
+	dirty = DirtyRegions(map_width, map_height)
+	panel_signature = None
+	# nowhere yet, so the first frame puts the whole screen up
+	camera_x = camera_y = None
+
+def new_game(seed=None, level=1, overworld=False):
+	global entities, scheduler, objects, player, inventory, game_state, player_action, game_msgs, game_stats, world
+
+	# every random choice in the game comes from this seed, so the same seed and keys give the same game
+	if seed is None:
+		seed = tcod.random_get_int(0, 0, 0x7FFFFFFF)
+
+	# a game started from the same seed before is in the level cache, in the save format
+	cache_path = level_cache_path(seed, level) if LEVEL_CACHE_DIR and not overworld else None
+	if cache_path and os.path.exists(cache_path):
+		try:
+			load_game(cache_path)
+			return
+		except ValueError:
+			pass   #not a complete level file, so build it again
+	seed_rngs(seed)
+
+	# a fresh store for the entities' data, with nothing on the map yet, and the game clock
+	entities = EntityStore()
+	scheduler = Scheduler()
+	objects = []
+
+	# create object representing player
+	fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
+	player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component)
+
+	#inventory
+	inventory = []
+	world = None
+	if overworld:
+		make_overworld()
+	else:
+		make_level(level)
+
+	game_state = 'playing'
+	player_action = None
+	# create the log of game messages and their colors, starts empty
+	game_msgs = MessageLog()
+	# turns played, kills and items used, for the balance runner
+	game_stats = collections.Counter()
+
+	# warm welcoming message!
+	message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', tcod.red)
+	if cache_path:
+		save_level_cache(cache_path)
+
+def play_game(source):
+	# run the main loop, taking keys from the given input source, until the player quits
+	global input_source
+	input_source = source
+	while not input_source.is_closed():
+		if play_turn() == 'exit':
+			break
 
-# warm welcoming message!
-message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', tcod.red)
-while not tcod.console_is_window_closed():
+def play_turn():
+	# one pass of the main loop: show the screen, wait for the player's key and play it, then the monsters'
+	# turns. nothing changes before the key is read, so an input source with no key ready yet can raise
+	# InputPending, and the turn can be played again from the start once there is one
+	global player_action
 
 	# render the screen
-	render_all()
-
-	tcod.console_flush()
+	with profiler.phase('render'):
+		render_all()
 
-	#erase all objects at their old locations, before they move
-	for object in objects:
-		object.clear()
+	if not headless:
+		with profiler.phase('flush'):
+			present()
 
-	# handle keys and exit game if needed
-	player_action = handle_keys()
+	# handle keys and exit game if needed (this includes waiting for the player)
+	with profiler.phase('input'):
+		player_action = handle_keys()
 	if player_action == 'exit':
-		break
+		return player_action
+	if world is not None:
+		world.follow()
 
 	# let monsters take their turn
 	if game_state == 'playing' and player_action != 'didnt-take-turn':
-		for object in objects:
-			if object.ai:
-				object.ai.take_turn()
+		game_stats['turns'] += 1
+		with profiler.phase('ai'):
+			take_monster_turns()
+	return player_action
+
+def run_headless(keys, seed=None, overworld=False, record=None):
+	# play a whole game without a window, pressing the given keys. returns how the game ended.
+	# with record, a replay of it is saved to that file, even if the game crashed
+	global headless
+	headless = True
+	new_game(seed, overworld=overworld)
+	source = ScriptedInput(keys)
+	if record:
+		source = RecordingInput(source)
+	try:
+		play_game(source)
+	finally:
+		if record:
+			save_replay(record, source.keys)
+	return game_state
+
+def main():
+	global MAP_GENERATOR, LEVEL_CACHE_DIR
+	parser = argparse.ArgumentParser(description='A roguelike.')
+	parser.add_argument('--headless', action='store_true', help='run without a window')
+	parser.add_argument('--keys', type=argparse.FileType('r'),
+		help='file of whitespace-separated keys to play (UP, DOWN, LEFT, RIGHT, ESCAPE, ENTER or single characters)')
+	parser.add_argument('--seed', type=int, help='seed for the random number generators')
+	parser.add_argument('--record', metavar='FILE', help='save a replay of the game to FILE when it ends')
+	parser.add_argument('--replay', metavar='FILE', help='play back a recorded game headless, as fast as possible')
+	parser.add_argument('--generator', choices=sorted(MAP_GENERATORS), default=MAP_GENERATOR,
+		help='how to lay out the dungeon')
+	parser.add_argument('--terminal', action='store_true',
+		help='play in this terminal (with 24-bit colors) instead of a window, e.g. over SSH')
+	parser.add_argument('--world', action='store_true',
+		help='play in an endless overworld, generated as you explore it, instead of the dungeon')
+	parser.add_argument('--level-cache', metavar='DIR',
+		help='keep the starting levels of new games in DIR, so the same seed starts faster next time')
+	parser.add_argument('--load', metavar='FILE', help='resume a saved game')
+	parser.add_argument('--save', metavar='FILE', help='save the game to FILE when quitting')
+	parser.add_argument('--trace', metavar='FILE',
+		help='write how long each phase of each turn took to FILE, as a Chrome trace (JSON)')
+	args = parser.parse_args()
+	if args.world and (args.load or args.save):
+		parser.error('games in the overworld can\'t be saved or loaded')
+	if args.load and args.record:
+		#a replay starts the game over from its seed, not from where the saved game was
+		parser.error('a loaded game can\'t be recorded')
+	if args.headless and (args.load or args.save):
+		parser.error('headless games can\'t be saved or loaded')
+
+	MAP_GENERATOR = args.generator
+	LEVEL_CACHE_DIR = args.level_cache
+	if args.trace:
+		profiler.start_trace()
+	try:
+		run(args)
+	finally:
+		if args.trace:
+			profiler.write_trace(args.trace)
+
+def run(args):
+	global MAP_GENERATOR, prefetcher
+	if args.replay:
+		(seed, MAP_GENERATOR, overworld, keys) = load_replay(args.replay)
+		print(run_headless(keys, seed, overworld))
+		return
+
+	if args.headless:
+		keys = args.keys.read().split() if args.keys else []
+		print(run_headless(keys, args.seed, args.world, args.record))
+		return
+
+	# from here to the first frame on the screen is what starting the game takes, after the imports
+	with profiler.phase('startup'):
+		if args.terminal:
+			init_terminal(sys.stdout.buffer)
+		else:
+			init_window()
+		if args.load:
+			load_game(args.load)
+		else:
+			new_game(args.seed, overworld=args.world)
+		render_all()
+		present()
+	if world is None:
+		#build the next level in the background while this one is played
+		prefetcher = LevelPrefetcher()
+		prefetcher.request(dungeon_level)
+	source = TerminalInput(sys.stdin.fileno()) if args.terminal else KeyboardInput()
+	if args.record:
+		source = RecordingInput(source)
+	try:
+		with raw_terminal(sys.stdin.fileno()) if args.terminal else contextlib.nullcontext():
+			play_game(source)
+		if args.save and game_state != 'dead':
+			save_game(args.save)
+	finally:
+		if terminal is not None:
+			terminal.close()
+		#save the replay even if the game crashed, that's when it's most useful
+		if args.record:
+			save_replay(args.record, source.keys)
+		if prefetcher:
+			prefetcher.shutdown()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# serves pyrogue over TCP, many games at once in one process. every connection gets its own game, drawn
+# with the ANSI terminal backend and played with the keys it sends, so any terminal that can pass raw keys
+# through works as a client:
+#
+#     python3 server.py --port 4000
+#     telnet localhost 4000            (or: socat -,raw,echo=0 tcp:localhost:4000)
+#
+# the game keeps its state in module globals, so each session holds its own copy of them (the names in
+# pyrogue.SESSION_GLOBALS) and swaps them in while it plays. a turn that needs a key that hasn't arrived yet
+# stops with InputPending and is played again from the start when it has. the levels are built in worker
+# processes shared by all the sessions, so the event loop never stalls on one.
+
+import argparse, asyncio, concurrent.futures, contextlib, io, multiprocessing, os, random, sys
+import pyrogue
+
+# telnet commands: Interpret As Command, and the options it negotiates
+IAC = 0xff
+SB = 0xfa
+SE = 0xf0
+WILL = 0xfb
+DONT = 0xfe
+# the server echoes (that is, doesn't) and sends no go-aheads, which puts telnet clients in character mode
+TELNET_SETUP = bytes([IAC, WILL, 1, IAC, WILL, 3])
+
+def strip_telnet(data):
+	# the key bytes in what a telnet client sent, without its option negotiation
+	keys = bytearray()
+	i = 0
+	while i < len(data):
+		byte = data[i]
+		if byte != IAC:
+			keys.append(byte)
+			i += 1
+		elif data[i + 1:i + 2] == bytes([IAC]):
+			keys.append(IAC)
+			i += 2
+		elif data[i + 1:i + 2] == bytes([SB]):
+			end = data.find(bytes([IAC, SE]), i)
+			i = len(data) if end < 0 else end + 2
+		elif data[i + 1:i + 2] and WILL <= data[i + 1] <= DONT:
+			i += 3   #the command and the option it's about
+		else:
+			i += 2
+	# telnet sends Enter as CR NUL or CR LF
+	return bytes(keys).replace(b'\r\x00', b'\r').replace(b'\r\n', b'\r')
+
+class SessionInput:
+	# the keys a client has sent that haven't been played yet. reading one that isn't there raises
+	# InputPending; the keys of a turn that had to stop are put back with rewind, to play it again
+	def __init__(self):
+		self.buffer = b''
+		self.position = 0
+		self.closed = False
+		self.lone_escape = False   #whether a final Escape is known not to start a sequence
+
+	def feed(self, data, lone_escape=False):
+		self.buffer = self.buffer[self.position:] + data
+		self.position = 0
+		self.lone_escape = lone_escape
+
+	def wait_for_key(self):
+		rest = self.buffer[self.position:]
+		(name, size) = pyrogue.decode_key(rest)
+		if name is None and rest == b'\x1b' and (self.lone_escape or self.closed):
+			(name, size) = ('ESCAPE', 1)
+		if name is None:
+			if self.closed:
+				return pyrogue.scripted_key('ESCAPE')
+			raise pyrogue.InputPending()
+		self.position += size
+		return pyrogue.scripted_key(name)
+
+	def is_closed(self):
+		return self.closed and self.position == len(self.buffer)
+
+class Session:
+	# one client's game
+	def __init__(self, executor):
+		self.input = SessionInput()
+		self.output = io.BytesIO()
+		self.started = False
+		self.state = {
+			'world': None,
+			'show_profile': False,
+			'fov_cache': pyrogue.FovCache(),
+			'prefetcher': pyrogue.LevelPrefetcher(executor=executor, block=False),
+			'input_source': self.input,
+		}
+
+	@contextlib.contextmanager
+	def active(self):
+		# put this session's game in the module globals while it's played, and keep what it left there
+		vars(pyrogue).update(self.state)
+		try:
+			yield
+		finally:
+			self.state = {name: getattr(pyrogue, name) for name in pyrogue.SESSION_GLOBALS}
+
+	def start(self, data):
+		# begin the game from its first level, as build_level made it
+		with self.active():
+			pyrogue.init_terminal(self.output)
+			pyrogue.load_game_from_bytes(data)
+			pyrogue.prefetcher.request(pyrogue.dungeon_level)
+		self.started = True
+
+	def play(self):
+		# play as many turns as there are keys for. returns 'exit' when the game is over, the future of a
+		# level to wait for before playing on, or None when it needs more keys
+		with self.active():
+			while True:
+				position = self.input.position
+				try:
+					if pyrogue.play_turn() == 'exit':
+						return 'exit'
+				except pyrogue.InputPending:
+					self.input.position = position
+					return None
+				except pyrogue.LevelPending as pending:
+					self.input.position = position
+					return pending.future
+
+	def take_output(self):
+		data = self.output.getvalue()
+		self.output.seek(0)
+		self.output.truncate()
+		return data
+
+	def close(self):
+		if not self.started:
+			return
+		with self.active():
+			pyrogue.terminal.close()
+			pyrogue.prefetcher.shutdown()
+
+class Server:
+	def __init__(self, executor, seed=None):
+		self.executor = executor
+		self.seeds = random.Random(seed)
+		self.sessions = set()
+
+	async def handle(self, reader, writer):
+		loop = asyncio.get_running_loop()
+		session = Session(self.executor)
+		self.sessions.add(session)
+		try:
+			writer.write(TELNET_SETUP)
+			# the first level is built away from the event loop too, like all the others
+			seed = self.seeds.randrange(0x7FFFFFFF)
+			data = await loop.run_in_executor(self.executor, pyrogue.build_level, seed, 1, pyrogue.level_settings())
+			session.start(data)
+			while True:
+				result = session.play()
+				writer.write(session.take_output())
+				await writer.drain()
+				if result == 'exit':
+					break
+				if result is not None:
+					await asyncio.wrap_future(result)
+					continue
+				await self.read_keys(reader, session.input)
+		except ConnectionError:
+			pass
+		finally:
+			self.sessions.discard(session)
+			session.close()
+			with contextlib.suppress(ConnectionError):
+				writer.write(session.take_output())
+				writer.close()
+				await writer.wait_closed()
+
+	async def read_keys(self, reader, input):
+		data = await reader.read(4096)
+		if not data:
+			input.closed = True
+			return
+		keys = strip_telnet(data)
+		lone_escape = False
+		if keys.endswith(b'\x1b') and pyrogue.decode_key(keys[keys.rfind(b'\x1b'):])[0] is None:
+			# an Escape on its own, unless the rest of a sequence follows right behind it
+			try:
+				more = await asyncio.wait_for(reader.read(4096), pyrogue.ANSI_ESCAPE_DELAY)
+			except asyncio.TimeoutError:
+				lone_escape = True
+			else:
+				input.closed = not more
+				keys += strip_telnet(more)
+		input.feed(keys, lone_escape)
+
+async def serve(host, port, jobs, seed):
+	#spawn rather than fork, so the workers don't inherit the server's sockets
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+	server = Server(executor, seed)
+	listener = await asyncio.start_server(server.handle, host, port)
+	print('serving on %s' % ', '.join(str(socket.getsockname()) for socket in listener.sockets), file=sys.stderr)
+	try:
+		async with listener:
+			await listener.serve_forever()
+	finally:
+		executor.shutdown(wait=False, cancel_futures=True)
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve games of pyrogue over TCP, to play in a terminal.')
+	parser.add_argument('--host', default='localhost', help='address to listen on')
+	parser.add_argument('--port', type=int, default=4000, help='port to listen on')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes that build the levels')
+	parser.add_argument('--seed', type=int, help='seed for the seeds of the games')
+	parser.add_argument('--generator', choices=sorted(pyrogue.MAP_GENERATORS), default=pyrogue.MAP_GENERATOR,
+		help='how to lay out the dungeon')
+	parser.add_argument('--level-cache', metavar='DIR', help='keep the starting levels of the games in DIR')
+	args = parser.parse_args()
+
+	pyrogue.MAP_GENERATOR = args.generator
+	pyrogue.LEVEL_CACHE_DIR = args.level_cache
+	with contextlib.suppress(KeyboardInterrupt):
+		asyncio.run(serve(args.host, args.port, args.jobs, args.seed))
+
+if __name__ == '__main__':
+	main()